@@ -0,0 +1,291 @@
+"""Index advisor for CSAggregateSentinelSankey and CsSentinelEvents.
+
+Replays the recorded request filters (plus one of each common filter shape) as the
+Sankey and breakdown statements the API runs, captures their plans (SHOWPLAN XML on
+MSSQL, EXPLAIN QUERY PLAN on SQLite), adds up scan and seek costs per filter shape
+and recommends covering/columnstore indexes. With apply, the recommended indexes are
+created and the replay is timed before and after; they are dropped again unless kept.
+
+    python advisor.py [--apply] [--keep] [--limit 20]
+"""
+import json
+import os
+import statistics
+import time
+import xml.etree.ElementTree as ElementTree
+
+from sqlalchemy import select, func, text
+
+from breakdown import filter_conditions, breakdown_statement, FLAG_COLUMNS
+from database import execute_parameterized, sp_executesql, MSSQL_SP_EXECUTESQL
+from models import CaseBreakdown, SankeyFilter, FILTER_COLUMNS, sentinel_events
+from rollup import EVENTS_PLAN
+
+ADVISOR_REPLAY_LIMIT = int(os.getenv("ADVISOR_REPLAY_LIMIT", "20"))
+ADVISOR_REPEAT = int(os.getenv("ADVISOR_REPEAT", "3"))
+# The API normally has no DDL rights on the warehouse; trial index creation over HTTP
+# (apply/keep) additionally needs this opt-in and a configured ADMIN_TOKEN
+INDEX_ADVISOR_APPLY = os.getenv("INDEX_ADVISOR_APPLY", "false").lower() in ("1", "true", "yes")
+
+SHOWPLAN = "{http://schemas.microsoft.com/sqlserver/2004/07/showplan}"
+SANKEY_TABLE = CaseBreakdown.__table__
+# Columns a Sankey query reads besides its filters, i.e. what a covering index must include
+SANKEY_OUTPUT = ["ord", "source", "target", "metric"]
+
+
+def filter_shape(filters):
+    return tuple(column for field, column in FILTER_COLUMNS.items() if getattr(filters, field)) + ("CohortYearMonth",)
+
+
+def sankey_statement(filters):
+    table = SANKEY_TABLE
+    return select(table.c.ord, table.c.source, table.c.target, func.sum(table.c.metric).label("total_metric")) \
+        .where(*filter_conditions(filters, table)) \
+        .group_by(table.c.ord, table.c.source, table.c.target)
+
+
+def sample_filters(db):
+    """One filter set per common shape, using values that exist in the table."""
+    row = db.execute(select(*(SANKEY_TABLE.c[column] for column in FILTER_COLUMNS.values()))
+                     .where(*(SANKEY_TABLE.c[column].isnot(None) for column in FILTER_COLUMNS.values()))
+                     .limit(1)).first()
+    if row is None:
+        return [SankeyFilter()]
+    values = dict(zip(FILTER_COLUMNS, row))
+    shapes = [(), ("County",), ("County", "SubCounty"), ("Partner",), ("Agency",), ("County", "Gender", "AgeGroup")]
+    return [SankeyFilter(**{field: [values[field]] for field in shape}) for shape in shapes]
+
+
+def replay_filters(db, recorded, limit=ADVISOR_REPLAY_LIMIT):
+    filter_sets = sample_filters(db) + [SankeyFilter(**filters) for filters, _ in recorded[:limit]]
+    unique = {}
+    for filters in filter_sets:
+        unique.setdefault(filters.model_dump_json(), filters)
+    return list(unique.values())
+
+
+def workload(filter_sets):
+    """(table, shape, statement) for every statement the API runs for these filters."""
+    for filters in filter_sets:
+        shape = filter_shape(filters)
+        yield SANKEY_TABLE.name, shape, sankey_statement(filters)
+        yield sentinel_events.name, shape, breakdown_statement(EVENTS_PLAN, filters)
+
+
+def parse_showplan(xml):
+    root = ElementTree.fromstring(xml)
+    cost = sum(float(statement.get("StatementSubTreeCost", 0)) for statement in root.iter(f"{SHOWPLAN}StmtSimple"))
+    operators = []
+    for relop in root.iter(f"{SHOWPLAN}RelOp"):
+        target = relop.find(f"./*/{SHOWPLAN}Object")
+        operators.append({
+            "op": relop.get("PhysicalOp"),
+            "object": None if target is None else ".".join(
+                part.strip("[]") for part in (target.get("Table"), target.get("Index")) if part),
+            "cost": float(relop.get("EstimateIO", 0)) + float(relop.get("EstimateCPU", 0)),
+        })
+    missing = []
+    for group in root.iter(f"{SHOWPLAN}MissingIndexGroup"):
+        for index in group.iter(f"{SHOWPLAN}MissingIndex"):
+            columns = {"EQUALITY": [], "INEQUALITY": [], "INCLUDE": []}
+            for column_group in index.iter(f"{SHOWPLAN}ColumnGroup"):
+                columns[column_group.get("Usage")] = [
+                    column.get("Name").strip("[]") for column in column_group.iter(f"{SHOWPLAN}Column")]
+            missing.append({
+                "table": index.get("Table").strip("[]"),
+                "impact": float(group.get("Impact", 0)),
+                "key": columns["EQUALITY"] + columns["INEQUALITY"],
+                "include": columns["INCLUDE"],
+            })
+    return {"cost": cost, "operators": operators, "missingIndexes": missing}
+
+
+def capture_plan(db, statement):
+    connection = db.connection()
+    dialect = connection.dialect
+    if dialect.name == "mssql":
+        connection.exec_driver_sql("SET SHOWPLAN_XML ON")
+        try:
+            if MSSQL_SP_EXECUTESQL:
+                xml = connection.exec_driver_sql(*sp_executesql(statement, dialect)).scalar()
+            else:
+                xml = connection.execute(statement).scalar()
+        finally:
+            connection.exec_driver_sql("SET SHOWPLAN_XML OFF")
+        return parse_showplan(xml)
+    if dialect.name == "sqlite":
+        sql = str(statement.compile(dialect=dialect, compile_kwargs={"literal_binds": True}))
+        operators = []
+        for row in connection.execute(text("EXPLAIN QUERY PLAN " + sql)):
+            detail = row[-1]
+            op = "Index Seek" if detail.startswith("SEARCH") else "Table Scan" if detail.startswith("SCAN") else None
+            if op is not None:
+                operators.append({"op": op, "object": detail.split(" ")[1], "cost": None, "detail": detail})
+        return {"cost": None, "operators": operators, "missingIndexes": []}
+    return {"cost": None, "operators": [], "missingIndexes": []}
+
+
+def is_scan(op):
+    return op is not None and "Scan" in op and "Constant" not in op
+
+
+def is_seek(op):
+    return op is not None and "Seek" in op
+
+
+def analyze(db, filter_sets):
+    """Scan vs seek operators and costs per (table, filter shape)."""
+    shapes = {}
+    for table, shape, statement in workload(filter_sets):
+        plan = capture_plan(db, statement)
+        entry = shapes.setdefault((table, shape), {
+            "table": table, "shape": list(shape), "statements": 0, "cost": 0.0,
+            "scans": 0, "seeks": 0, "scanCost": 0.0, "seekCost": 0.0, "operators": {}, "missingIndexes": [],
+        })
+        entry["statements"] += 1
+        entry["cost"] += plan["cost"] or 0.0
+        for operator in plan["operators"]:
+            kind = "scans" if is_scan(operator["op"]) else "seeks" if is_seek(operator["op"]) else None
+            if kind is not None:
+                entry[kind] += 1
+                entry["scanCost" if kind == "scans" else "seekCost"] += operator["cost"] or 0.0
+            name = f'{operator["op"]} {operator["object"] or ""}'.strip()
+            entry["operators"][name] = entry["operators"].get(name, 0) + 1
+        entry["missingIndexes"] += plan["missingIndexes"]
+    return list(shapes.values())
+
+
+def index_name(table, key):
+    return f"IX_{table}_" + "_".join(key)
+
+
+def recommendations(shapes, dialect_name):
+    """Covering indexes for the shapes that scan, the optimizer's own suggestions and,
+    on MSSQL, a columnstore index for the many-flag breakdown aggregates."""
+    recommended = {}
+
+    def add(table, key, include, reason):
+        key = list(dict.fromkeys(key))
+        include = [column for column in dict.fromkeys(include) if column not in key]
+        name = index_name(table, key)
+        if name not in recommended:
+            recommended[name] = {"name": name, "table": table, "key": key, "include": [], "reasons": []}
+        index = recommended[name]
+        index["include"] += [column for column in include if column not in index["include"]]
+        index["reasons"].append(reason)
+
+    events_scanned = False
+    for entry in shapes:
+        for missing in entry["missingIndexes"]:
+            add(missing["table"], missing["key"], missing["include"],
+                f'optimizer missing index for {entry["shape"]} (impact {missing["impact"]:.0f}%)')
+        if entry["scans"] == 0 or entry["scanCost"] < entry["seekCost"]:
+            continue
+        if entry["table"] == SANKEY_TABLE.name:
+            # Equality columns first, the CohortYearMonth range last, Sankey outputs included
+            add(entry["table"], entry["shape"], SANKEY_OUTPUT, f'{entry["shape"]} scans the table')
+        elif dialect_name != "mssql":
+            add(entry["table"], entry["shape"], ["Gender"] + FLAG_COLUMNS, f'{entry["shape"]} scans the table')
+        else:
+            events_scanned = True
+
+    result = [{**index, "ddl": create_index(index, dialect_name)} for index in recommended.values()]
+    if events_scanned:
+        columns = list(FILTER_COLUMNS.values()) + ["CohortYearMonth"] + FLAG_COLUMNS
+        name = f"NCCI_{sentinel_events.name}_breakdown"
+        result.append({
+            "name": name, "table": sentinel_events.name, "key": columns, "include": [],
+            "reasons": ["breakdowns aggregate many flag columns over wide ranges; batch-mode columnstore scans"],
+            "ddl": f"CREATE NONCLUSTERED COLUMNSTORE INDEX [{name}] ON [{sentinel_events.name}] "
+                   f"({', '.join(f'[{column}]' for column in columns)})",
+        })
+    return result
+
+
+def create_index(index, dialect_name):
+    if dialect_name == "mssql":
+        ddl = f"CREATE NONCLUSTERED INDEX [{index['name']}] ON [{index['table']}] " \
+              f"({', '.join(f'[{column}]' for column in index['key'])})"
+        if index["include"]:
+            ddl += f" INCLUDE ({', '.join(f'[{column}]' for column in index['include'])})"
+        return ddl
+    # No INCLUDE elsewhere: the included columns become trailing key columns
+    return f'CREATE INDEX "{index["name"]}" ON "{index["table"]}" ' \
+           f'({", ".join(f"{chr(34)}{column}{chr(34)}" for column in index["key"] + index["include"])})'
+
+
+def drop_index(index, dialect_name):
+    if dialect_name == "mssql":
+        return f"DROP INDEX [{index['name']}] ON [{index['table']}]"
+    return f'DROP INDEX "{index["name"]}"'
+
+
+def time_workload(db, filter_sets, repeat=ADVISOR_REPEAT):
+    """Median milliseconds per (table, shape) over ``repeat`` replays of the workload."""
+    passes = []
+    for _ in range(repeat):
+        totals = {}
+        for table, shape, statement in workload(filter_sets):
+            started = time.perf_counter()
+            execute_parameterized(db, statement)
+            totals[(table, shape)] = totals.get((table, shape), 0.0) + (time.perf_counter() - started) * 1000
+        passes.append(totals)
+    return {key: statistics.median(totals[key] for totals in passes) for key in passes[0]}
+
+
+def advise(db, recorded=(), limit=ADVISOR_REPLAY_LIMIT, apply=False, keep=False):
+    dialect_name = db.connection().dialect.name
+    filter_sets = replay_filters(db, list(recorded), limit)
+    shapes = analyze(db, filter_sets)
+    report = {
+        "dialect": dialect_name,
+        "filterSets": len(filter_sets),
+        "shapes": shapes,
+        "recommendations": recommendations(shapes, dialect_name),
+    }
+    if not apply:
+        return report
+
+    before = time_workload(db, filter_sets)
+    created = []
+    try:
+        for index in report["recommendations"]:
+            db.execute(text(index["ddl"]))
+            db.commit()
+            created.append(index)
+        after = time_workload(db, filter_sets)
+        report["shapesAfter"] = analyze(db, filter_sets)
+    finally:
+        if not keep:
+            for index in created:
+                db.execute(text(drop_index(index, dialect_name)))
+                db.commit()
+    report["timings"] = [
+        {"table": table, "shape": list(shape), "beforeMs": round(before[table, shape], 2),
+         "afterMs": round(after[table, shape], 2)}
+        for table, shape in before
+    ]
+    report["applied"] = [index["name"] for index in created]
+    report["kept"] = keep
+    return report
+
+
+def main():
+    import argparse
+
+    from database import SessionLocal
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--apply", action="store_true", help="create the recommended indexes and time the replay")
+    parser.add_argument("--keep", action="store_true", help="keep the indexes created by --apply")
+    parser.add_argument("--limit", type=int, default=ADVISOR_REPLAY_LIMIT)
+    args = parser.parse_args()
+    db = SessionLocal()
+    try:
+        print(json.dumps(advise(db, limit=args.limit, apply=args.apply, keep=args.keep), indent=2, default=str))
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
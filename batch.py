@@ -0,0 +1,80 @@
+from sqlalchemy import select, func, or_
+
+from breakdown import filter_conditions, dimension_conditions, window_condition
+from cache import filter_key
+from database import execute_parameterized
+from models import CaseBreakdown, FILTER_COLUMNS, cohort_window, in_window
+
+# Dimensions a comparison can vary in: any filter list, or the cohort window itself
+WINDOW = "CohortYearMonth"
+GROUP_DIMENSIONS = list(FILTER_COLUMNS) + [WINDOW]
+
+
+def _without(filters, field):
+    if field == WINDOW:
+        return filter_key(filters.model_copy(update={"CohortYearMonthStart": None, "CohortYearMonthEnd": None}))
+    return filter_key(filters.model_copy(update={field: None}))
+
+
+def plan_groups(filter_sets):
+    """Split filter sets into groups that are identical except for one dimension.
+
+    Returns [(field, [filters, ...])]; a group of one has field None and is queried
+    on its own. Groups are picked greedily, largest first.
+    """
+    pending = list(filter_sets)
+    groups = []
+    while pending:
+        best = None
+        for field in GROUP_DIMENSIONS:
+            buckets = {}
+            for filters in pending:
+                # An empty list means "everything", which a union of values cannot reproduce
+                if field != WINDOW and not getattr(filters, field):
+                    continue
+                buckets.setdefault(_without(filters, field), []).append(filters)
+            for members in buckets.values():
+                if len(members) > 1 and (best is None or len(members) > len(best[1])):
+                    best = (field, members)
+        if best is None:
+            groups.extend((None, [filters]) for filters in pending)
+            break
+        groups.append(best)
+        pending = [filters for filters in pending if not any(filters is member for member in best[1])]
+    return groups
+
+
+def query_grouped_flows(db, field, members):
+    """Sankey flows for every member of a group from one scan grouped by the differing dimension."""
+    table = CaseBreakdown.__table__
+    first = members[0]
+    if field == WINDOW:
+        column = table.c.CohortYearMonth
+        conditions = dimension_conditions(first, table) + [or_(*(window_condition(member, table) for member in members))]
+    else:
+        column = table.c[FILTER_COLUMNS[field]]
+        union = sorted({value for member in members for value in getattr(member, field)}, key=str)
+        conditions = filter_conditions(first.model_copy(update={field: union}), table)
+    statement = select(column, table.c.ord, table.c.source, table.c.target,
+                       func.sum(table.c.metric).label("total_metric")) \
+        .where(*conditions) \
+        .group_by(column, table.c.ord, table.c.source, table.c.target)
+    rows = execute_parameterized(db, statement)
+
+    results = []
+    for member in members:
+        if field == WINDOW:
+            window = cohort_window(member)
+            selected = {value for value, *_ in rows if in_window(value, *window)}
+        else:
+            selected = set(getattr(member, field))
+        totals = {}
+        for value, ord_, source, target, total in rows:
+            if value in selected:
+                link = (ord_, source, target)
+                totals[link] = totals.get(link, 0) + (total or 0)
+        results.append([
+            {"from": source, "to": target, "weight": total}
+            for (ord_, source, target), total in sorted(totals.items(), key=lambda item: item[0][0])
+        ])
+    return results
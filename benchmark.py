@@ -0,0 +1,312 @@
+"""Latency benchmark for /sankey-data/ and /sankey-data/breakdown.
+
+Seeds a local SQLite stand-in for CSAggregateSentinelSankey and CsSentinelEvents
+with synthetic data, points the app at it and replays a weighted mix of realistic
+filters in-process, reporting latency percentiles, throughput and SQL statements
+per request for each scenario. Before timing, it checks that the sql, rollup and
+snapshot engines return the same payloads (--skip-parity to skip).
+
+    python benchmark.py --counties 47 --events 200000 --requests 500 --concurrency 16
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+from sqlalchemy import create_engine, event, text
+
+SANKEY_LINKS = [
+    (1, "Total Cases Reported", "Linked"),
+    (1, "Total Cases Reported", "Not Linked"),
+    (2, "Linked", "Initial CD4 Done"),
+    (2, "Linked", "Initial CD4 Not Done"),
+    (3, "Initial CD4 Done", "With AHD"),
+    (3, "Initial CD4 Done", "Without AHD"),
+    (3, "Initial CD4 Done", "Not Staged"),
+    (4, "With AHD", "Initial Viral Load Done"),
+    (4, "With AHD", "Initial Viral Load Not Done"),
+    (5, "Initial Viral Load Done", "Initial Viral Load Suppressed"),
+    (5, "Initial Viral Load Done", "Initial Viral Load Unsuppressed"),
+    (6, "Initial Viral Load Suppressed", "Regimen Change Done"),
+    (6, "Initial Viral Load Suppressed", "Regimen Change Not Done"),
+    (7, "Regimen Change Not Done", "Latest Viral Load Suppressed"),
+    (7, "Regimen Change Not Done", "Latest Viral Load Unsuppressed"),
+    (8, "Latest Viral Load Suppressed", "Patients Retained"),
+    (8, "Latest Viral Load Suppressed", "Patients Not Retained"),
+]
+GENDERS = ["Male", "Female"]
+AGE_GROUPS = ["<15", "15-19", "20-24", "25-29", "30-34", "35-39", "40-44", "45-49", "50+"]
+AGENCIES = ["CDC", "USAID", "DOD"]
+
+
+def months(count):
+    return [f"{2022 + index // 12}-{index % 12 + 1:02d}-01" for index in range(count)]
+
+
+def geography(args):
+    return {
+        f"County {county:02d}": [f"SubCounty {county:02d}-{sub}" for sub in range(args.subcounties)]
+        for county in range(args.counties)
+    }
+
+
+def seed(path, args):
+    from breakdown import FLAG_COLUMNS
+
+    rnd = random.Random(args.seed)
+    counties = geography(args)
+    partners = [f"Partner {index:02d}" for index in range(args.partners)]
+    cohort_months = months(args.months)
+    engine = create_engine(f"sqlite:///{path}")
+    with engine.begin() as connection:
+        connection.execute(text("DROP TABLE IF EXISTS CSAggregateSentinelSankey"))
+        connection.execute(text("DROP TABLE IF EXISTS CsSentinelEvents"))
+        connection.execute(text(
+            "CREATE TABLE CSAggregateSentinelSankey (source TEXT, target TEXT, metric INTEGER, ord INTEGER, "
+            "County TEXT, AgeGroup TEXT, SubCounty TEXT, Gender TEXT, AgencyName TEXT, PartnerName TEXT, "
+            "CohortYearMonth TEXT)"
+        ))
+        connection.execute(text(
+            "CREATE TABLE CsSentinelEvents (County TEXT, SubCounty TEXT, AgencyName TEXT, PartnerName TEXT, "
+            "Gender TEXT, AgeGroup TEXT, CohortYearMonth TEXT, "
+            + ", ".join(f"{column} INTEGER" for column in FLAG_COLUMNS) + ")"
+        ))
+
+        rows = []
+        for county, subcounties in counties.items():
+            for subcounty in subcounties:
+                partner = rnd.choice(partners)
+                agency = rnd.choice(AGENCIES)
+                for month in cohort_months:
+                    for gender in GENDERS:
+                        for age_group in rnd.sample(AGE_GROUPS, args.age_groups):
+                            for ord_, source, target in SANKEY_LINKS:
+                                rows.append((source, target, rnd.randint(0, 40), ord_, county, age_group,
+                                             subcounty, gender, agency, partner, month))
+        connection.exec_driver_sql(
+            "INSERT INTO CSAggregateSentinelSankey VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows
+        )
+
+        events = []
+        for _ in range(args.events):
+            county = rnd.choice(list(counties))
+            events.append((county, rnd.choice(counties[county]), rnd.choice(AGENCIES), rnd.choice(partners),
+                           rnd.choice(GENDERS), rnd.choice(AGE_GROUPS), rnd.choice(cohort_months))
+                          + tuple(rnd.randint(0, 1) for _ in FLAG_COLUMNS))
+        placeholders = ", ".join("?" * (7 + len(FLAG_COLUMNS)))
+        connection.exec_driver_sql(f"INSERT INTO CsSentinelEvents VALUES ({placeholders})", events)
+    engine.dispose()
+    return len(rows)
+
+
+def scenarios(args):
+    from breakdown import NODES
+
+    rnd = random.Random(args.seed + 1)
+    counties = geography(args)
+    partners = [f"Partner {index:02d}" for index in range(args.partners)]
+    cohort_months = months(args.months)
+    nodes = list(NODES)
+
+    def window():
+        start = rnd.randrange(len(cohort_months) - 1)
+        end = rnd.randrange(start + 1, len(cohort_months))
+        return {"CohortYearMonthStart": cohort_months[start], "CohortYearMonthEnd": cohort_months[end]}
+
+    # (name, weight, endpoint, body factory)
+    return [
+        ("national", 30, "/sankey-data/", lambda: {}),
+        ("county", 25, "/sankey-data/", lambda: {"County": [rnd.choice(list(counties))]}),
+        ("multi-county", 5, "/sankey-data/", lambda: {"County": rnd.sample(list(counties), min(3, len(counties)))}),
+        ("subcounty", 5, "/sankey-data/", lambda: (lambda county: {
+            "County": [county], "SubCounty": [rnd.choice(counties[county])]})(rnd.choice(list(counties)))),
+        ("partner", 10, "/sankey-data/", lambda: {"Partner": [rnd.choice(partners)]}),
+        ("county+gender+age", 5, "/sankey-data/", lambda: {
+            "County": [rnd.choice(list(counties))], "Gender": [rnd.choice(GENDERS)],
+            "AgeGroup": rnd.sample(AGE_GROUPS, 2)}),
+        ("date-window", 5, "/sankey-data/", window),
+        ("breakdown", 12, "/sankey-data/breakdown", lambda: {"node": rnd.choice(nodes), **window()}),
+        ("breakdown-county", 3, "/sankey-data/breakdown", lambda: {
+            "node": rnd.choice(nodes), "County": [rnd.choice(list(counties))], **window()}),
+    ]
+
+
+async def check_parity(args, samples=5):
+    """Assert that the sql, rollup and snapshot engines return the same payloads.
+
+    A few bodies of every scenario are answered by each engine directly (bypassing the
+    result cache); breakdowns are also compared across several dimensions at once.
+    """
+    import main
+    from breakdown import BreakdownPlan, DEFAULT_DIMENSIONS
+    from database import run_db
+    from models import SankeyFilter, SankeyBreakdown
+    from rollup import SankeyRollups, EventRollups
+    from snapshot import SankeySnapshot, EventsSnapshot
+
+    sankey_rollups, event_rollups = SankeyRollups(enabled=True), EventRollups(enabled=True)
+    sankey_snapshot, events_snapshot = SankeySnapshot(shared_dir=""), EventsSnapshot(shared_dir="")
+    await asyncio.gather(sankey_rollups.build(), event_rollups.build(),
+                         sankey_snapshot.ensure_loaded(), events_snapshot.ensure_loaded())
+
+    def flows(result):
+        return sorted((link["from"], link["to"], link["weight"]) for link in result)
+
+    def tables(plan, name, result, dimensions):
+        return [
+            (table["tableTitle"], sorted(sorted(row.items()) for row in table["rows"]))
+            for dimension in dimensions for table in plan.tables(name, result[dimension], dimension)
+        ]
+
+    checked = 0
+    for name, _, endpoint, body in scenarios(args):
+        for _ in range(samples):
+            request = body()
+            comparisons = []
+            if endpoint == "/sankey-data/":
+                filters = SankeyFilter(**request)
+                rolled_up = sankey_rollups.flows(filters)
+                comparisons.append({
+                    "sql": flows(await run_db(main.query_sankey_flows, filters)),
+                    "rollup": None if rolled_up is None else flows(rolled_up),
+                    "snapshot": flows(sankey_snapshot.flows(filters)),
+                })
+            else:
+                node = SankeyBreakdown(**request)
+                plan = BreakdownPlan([node.node])
+                # The default rollups cover County/Partner/Agency but not AgeGroup/SubCounty
+                for dimensions in (DEFAULT_DIMENSIONS, ("Gender", "County", "Partner", "Agency"),
+                                   ("AgeGroup", "SubCounty")):
+                    rolled_up = event_rollups.counts(plan, node, dimensions)
+                    comparisons.append({
+                        "sql": tables(plan, node.node, await run_db(main.query_breakdown, plan, node, dimensions),
+                                      dimensions),
+                        "rollup": None if rolled_up is None else tables(plan, node.node, rolled_up, dimensions),
+                        "snapshot": tables(plan, node.node, events_snapshot.counts(plan, node, dimensions),
+                                           dimensions),
+                    })
+            for results in comparisons:
+                # A rollup that does not cover the filters answers None, i.e. falls back to SQL
+                for engine_name, result in results.items():
+                    if result is not None and result != results["sql"]:
+                        raise AssertionError(f"{engine_name} differs from sql for {name} {request}")
+                checked += 1
+    print(f"parity: sql, rollup and snapshot agree on {checked} comparisons", file=sys.stderr)
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, round(fraction * len(ordered)) - 1))
+    return ordered[index]
+
+
+async def run(args):
+    import httpx
+    import main
+    from database import engine
+
+    statements = {"count": 0}
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def count_statement(*_):
+        statements["count"] += 1
+
+    mix = scenarios(args)
+    rnd = random.Random(args.seed + 2)
+    plan = rnd.choices(mix, weights=[weight for _, weight, _, _ in mix], k=args.requests)
+    results = {name: {"latency": [], "statements": 0, "errors": 0, "bytes": 0} for name, _, _, _ in mix}
+    headers = {"Accept-Encoding": args.encoding}
+    params = {"format": args.format} if args.format else {}
+    queue = asyncio.Queue()
+    for item in plan:
+        queue.put_nowait((item[0], item[2], item[3]()))
+
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://benchmark") as client:
+        async def worker():
+            while not queue.empty():
+                name, endpoint, body = queue.get_nowait()
+                before = statements["count"]
+                start = time.perf_counter()
+                response = await client.post(endpoint, json=body, headers=headers,
+                                             params=params if endpoint == "/sankey-data/" else {})
+                results[name]["latency"].append(time.perf_counter() - start)
+                results[name]["bytes"] += response.num_bytes_downloaded
+                # Attribution is approximate when requests overlap; run with --concurrency 1 for exact counts
+                results[name]["statements"] += statements["count"] - before
+                if response.status_code != 200:
+                    results[name]["errors"] += 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+        elapsed = time.perf_counter() - started
+
+    print(f"{'scenario':<20}{'n':>6}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'sql/req':>9}{'kB/resp':>9}"
+          f"{'errors':>8}")
+    every = []
+    for name, result in results.items():
+        latency = result["latency"]
+        if not latency:
+            continue
+        every.extend(latency)
+        print(f"{name:<20}{len(latency):>6}"
+              f"{percentile(latency, 0.50) * 1000:>10.1f}{percentile(latency, 0.95) * 1000:>10.1f}"
+              f"{percentile(latency, 0.99) * 1000:>10.1f}{result['statements'] / len(latency):>9.2f}"
+              f"{result['bytes'] / len(latency) / 1024:>9.2f}{result['errors']:>8}")
+    print(f"{'all':<20}{len(every):>6}"
+          f"{percentile(every, 0.50) * 1000:>10.1f}{percentile(every, 0.95) * 1000:>10.1f}"
+          f"{percentile(every, 0.99) * 1000:>10.1f}{statements['count'] / len(every):>9.2f}")
+    print(f"throughput: {len(every) / elapsed:.1f} req/s over {elapsed:.2f}s, "
+          f"mean {statistics.mean(every) * 1000:.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--db", help="SQLite file to seed (default: a temporary file)")
+    parser.add_argument("--reuse", action="store_true", help="use --db as already seeded")
+    parser.add_argument("--counties", type=int, default=47)
+    parser.add_argument("--subcounties", type=int, default=6, help="subcounties per county")
+    parser.add_argument("--partners", type=int, default=40)
+    parser.add_argument("--months", type=int, default=24)
+    parser.add_argument("--age-groups", type=int, default=3, help="age groups per subcounty/month/gender")
+    parser.add_argument("--events", type=int, default=100000, help="CsSentinelEvents rows")
+    parser.add_argument("--requests", type=int, default=300)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--no-cache", action="store_true", help="disable the result cache")
+    parser.add_argument("--sankey-engine", choices=["sql", "snapshot"], default="sql")
+    parser.add_argument("--breakdown-engine", choices=["sql", "snapshot"], default="sql")
+    parser.add_argument("--no-rollups", action="store_true")
+    parser.add_argument("--format", choices=["links", "compact"], help="sankeyData format to request")
+    parser.add_argument("--encoding", default="identity", help="Accept-Encoding sent with each request")
+    parser.add_argument("--skip-parity", action="store_true",
+                        help="skip checking that the sql, rollup and snapshot engines agree")
+    args = parser.parse_args()
+
+    path = args.db or os.path.join(tempfile.mkdtemp(prefix="sankey-bench-"), "bench.sqlite")
+    # The app reads its configuration at import time
+    os.environ["DATABASE_URL"] = f"sqlite:///{path}"
+    os.environ["SANKEY_ENGINE"] = args.sankey_engine
+    os.environ["BREAKDOWN_ENGINE"] = args.breakdown_engine
+    if args.no_cache:
+        os.environ["SANKEY_CACHE_MAXSIZE"] = "0"
+    if args.no_rollups:
+        os.environ["SANKEY_ROLLUPS_ENABLED"] = "false"
+        os.environ["BREAKDOWN_ROLLUPS_ENABLED"] = "false"
+
+    if not args.reuse:
+        started = time.perf_counter()
+        rows = seed(path, args)
+        print(f"seeded {rows} aggregate rows and {args.events} events in {time.perf_counter() - started:.1f}s "
+              f"({path})", file=sys.stderr)
+    if not args.skip_parity:
+        asyncio.run(check_parity(args))
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,283 @@
+from collections import namedtuple
+from typing import List
+
+from pydantic import TypeAdapter
+from sqlalchemy import select, func, case, and_, literal_column, null, union_all
+
+from models import sentinel_events, FILTER_COLUMNS, cohort_window, BreakdownTable
+
+# Declarative registry for the node breakdown tables. Every metric is a count of
+# CsSentinelEvents rows where a 0/1 flag has a given value, and every node is a
+# conjunction of such flag conditions, so any (node, metric) pair collapses into a
+# single conditional aggregate and all nodes can share one GROUP BY Gender scan.
+
+Metric = namedtuple("Metric", ["field", "header", "column", "value", "min_width"])
+Node = namedtuple("Node", ["title", "where", "metrics"])
+
+METRICS = {
+    "linked": Metric("linked", "Linked", "LinkedToART", 1, 100),
+    "notLinked": Metric("notLinked", "Not Linked", "NotLinkedOnART", 1, 100),
+    "initialCD4Done": Metric("initialCD4Done", "Initial CD4 Done", "WithBaselineCD4", 1, 150),
+    "initialCD4NotDone": Metric("initialCD4NotDone", "Initial CD4 Not Done", "WithoutBaselineCD4", 1, 150),
+    "withAHD": Metric("withAHD", "With AHD", "AHD", 1, 100),
+    "WithoutAHD": Metric("WithoutAHD", "Without AHD", "AHD", 0, 100),
+    "NotStaged": Metric("NotStaged", "Not Staged", "NotStaged", 1, 100),
+    "InitialViralLoadDone": Metric("InitialViralLoadDone", "Initial Viral Load Done", "WithInitialViralLoad", 1, 150),
+    "InitialViralLoadNotDone": Metric("InitialViralLoadNotDone", "Initial Viral Load Not Done", "WithoutInitialViralLoad", 1, 150),
+    "InitialViralLoadSuppressed": Metric("InitialViralLoadSuppressed", "Initial Viral Load Suppressed", "IsSuppressedInitialViralload", 1, 150),
+    "InitialViralLoadUnsuppressed": Metric("InitialViralLoadUnsuppressed", "Initial Viral Load Unsuppressed", "IsSuppressedInitialViralload", 0, 150),
+    "RegimenChangeDone": Metric("RegimenChangeDone", "Regimen Change Done", "RegimenChanged", 1, 150),
+    "RegimenChangeNotDone": Metric("RegimenChangeNotDone", "Regimen Change Not Done", "RegimenNotChanged", 1, 150),
+    "LatestVLSuppressed": Metric("LatestVLSuppressed", "Latest VL Suppressed", "LatestVLSuppressed", 1, 150),
+    "LatestVLUnsuppressed": Metric("LatestVLUnsuppressed", "Latest VL Unsuppressed", "LatestVLNotSuppressed", 1, 150),
+    "PatientsRetained": Metric("PatientsRetained", "Patients Retained", "PatientRetained", 1, 150),
+    "PatientsNotRetained": Metric("PatientsNotRetained", "Patients Not Retained", "PatientNotRetained", 1, 150),
+}
+
+FOLLOWUP_TITLE = "Sex Distribution For Followup Events"
+
+_RETENTION = ["PatientsRetained", "PatientsNotRetained"]
+_LATEST_VL = ["LatestVLSuppressed", "LatestVLUnsuppressed"] + _RETENTION
+_REGIMEN = ["RegimenChangeDone", "RegimenChangeNotDone"] + _LATEST_VL
+_INITIAL_VL = [
+    "InitialViralLoadDone", "InitialViralLoadNotDone",
+    "InitialViralLoadSuppressed", "InitialViralLoadUnsuppressed",
+] + _REGIMEN
+_STAGING = ["withAHD", "WithoutAHD", "NotStaged"] + _INITIAL_VL
+
+_LINKED = {"LinkedToART": 1}
+_BASELINE_CD4 = {"LinkedToART": 1, "WithBaselineCD4": 1}
+
+NODES = {
+    "Total Cases Reported": Node(FOLLOWUP_TITLE, {}, [
+        "linked", "notLinked", "initialCD4Done", "initialCD4NotDone"] + _STAGING),
+    "Linked": Node(FOLLOWUP_TITLE, _LINKED, [
+        "linked", "initialCD4Done", "initialCD4NotDone"] + _STAGING),
+    "Not Linked": Node("Sex Distribution Among New Cases Reported", {}, ["notLinked"]),
+    "Initial CD4 Not Done": Node(FOLLOWUP_TITLE, {**_LINKED, "WithoutBaselineCD4": 1}, [
+        "initialCD4NotDone"] + _INITIAL_VL),
+    "Initial CD4 Done": Node(FOLLOWUP_TITLE, _BASELINE_CD4, ["initialCD4Done"] + _STAGING),
+    "With AHD": Node(FOLLOWUP_TITLE, {**_BASELINE_CD4, "AHD": 1}, ["withAHD"] + _INITIAL_VL),
+    "Without AHD": Node(FOLLOWUP_TITLE, {**_BASELINE_CD4, "AHD": 0}, ["WithoutAHD"] + _INITIAL_VL),
+    "Not Staged": Node(FOLLOWUP_TITLE, {**_BASELINE_CD4, "NotStaged": 1}, ["NotStaged"] + _INITIAL_VL),
+    "Initial Viral Load Done": Node(FOLLOWUP_TITLE, {**_LINKED, "WithInitialViralLoad": 1}, [
+        "InitialViralLoadDone", "InitialViralLoadSuppressed", "InitialViralLoadUnsuppressed"] + _REGIMEN),
+    "Initial Viral Load Not Done": Node(FOLLOWUP_TITLE, {**_LINKED, "WithoutInitialViralLoad": 1}, [
+        "InitialViralLoadNotDone"] + _REGIMEN),
+    "Initial Viral Load Suppressed": Node(FOLLOWUP_TITLE, {
+        **_LINKED, "IsSuppressedInitialViralload": 1, "WithoutInitialViralLoad": 0}, [
+        "InitialViralLoadSuppressed"] + _REGIMEN),
+    "Initial Viral Load Unsuppressed": Node(FOLLOWUP_TITLE, {
+        **_LINKED, "IsSuppressedInitialViralload": 0, "WithoutInitialViralLoad": 0}, [
+        "InitialViralLoadUnsuppressed"] + _REGIMEN),
+    "Regimen Change Not Done": Node(FOLLOWUP_TITLE, {**_LINKED, "RegimenNotChanged": 1}, [
+        "RegimenChangeNotDone"] + _LATEST_VL),
+    "Regimen Change Done": Node(FOLLOWUP_TITLE, {**_LINKED, "RegimenChanged": 1}, [
+        "RegimenChangeDone"] + _LATEST_VL),
+    "Latest Viral Load Unsuppressed": Node(FOLLOWUP_TITLE, {**_LINKED, "LatestVLNotSuppressed": 1}, [
+        "LatestVLUnsuppressed"] + _RETENTION),
+    "Latest Viral Load Suppressed": Node(FOLLOWUP_TITLE, {**_LINKED, "LatestVLSuppressed": 1}, [
+        "LatestVLSuppressed"] + _RETENTION),
+    "Patients Not Retained": Node(FOLLOWUP_TITLE, {**_LINKED, "PatientNotRetained": 1}, ["PatientsNotRetained"]),
+    "Patients Retained": Node(FOLLOWUP_TITLE, {**_LINKED, "PatientRetained": 1}, ["PatientsRetained"]),
+}
+
+# Any other node name falls back to the linked-to-ART count for the whole slice.
+DEFAULT_NODE = Node("Sex Distribution", {}, ["linked"])
+
+# Single-metric tables keep their historical "number" column.
+NUMBER_COLUMN = {"field": "number", "headerName": "Number", "flex": 1, "minWidth": 100}
+GENDER_COLUMN = {"field": "gender", "headerName": "Sex", "flex": 1, "minWidth": 100}
+
+# Breakdown dimensions (filter field names) and the first column of their tables; the
+# Gender table keeps the historical "gender"/"Sex" column.
+DIMENSION_COLUMNS = {
+    "Gender": GENDER_COLUMN,
+    "AgeGroup": {"field": "ageGroup", "headerName": "Age Group", "flex": 1, "minWidth": 100},
+    "County": {"field": "county", "headerName": "County", "flex": 1, "minWidth": 150},
+    "SubCounty": {"field": "subCounty", "headerName": "Sub County", "flex": 1, "minWidth": 150},
+    "Agency": {"field": "agency", "headerName": "Agency", "flex": 1, "minWidth": 150},
+    "Partner": {"field": "partner", "headerName": "Partner", "flex": 1, "minWidth": 150},
+}
+DEFAULT_DIMENSIONS = ("Gender",)
+# Dialects that can compute several breakdowns in one scan with GROUP BY GROUPING SETS;
+# the others get the same rows from a UNION ALL of one GROUP BY per dimension.
+GROUPING_SETS_DIALECTS = ("mssql", "postgresql", "oracle")
+
+# Every 0/1 flag column of CsSentinelEvents the registry reads
+FLAG_COLUMNS = sorted(
+    {metric.column for metric in METRICS.values()} |
+    {column for node in NODES.values() for column in node.where}
+)
+
+
+def resolve_node(name):
+    if "highcharts" in name:
+        return None
+    return NODES.get(name, DEFAULT_NODE)
+
+
+def _conjunction(*conditions):
+    merged = {}
+    for condition in conditions:
+        for column, value in condition.items():
+            if merged.get(column, value) != value:
+                return None
+            merged[column] = value
+    return tuple(sorted(merged.items()))
+
+
+class BreakdownPlan:
+    """Conditional aggregates needed to answer a set of nodes from one scan."""
+
+    def __init__(self, node_names):
+        self.nodes = {}
+        self.aliases = {}
+        for name in node_names:
+            node = resolve_node(name)
+            if node is not None:
+                self.nodes[name] = node
+        for node in self.nodes.values():
+            self._alias(_conjunction(node.where))
+            for key in node.metrics:
+                metric = METRICS[key]
+                self._alias(_conjunction(node.where, {metric.column: metric.value}))
+
+    def _alias(self, conjunction):
+        if conjunction is not None and conjunction not in self.aliases:
+            self.aliases[conjunction] = f"c{len(self.aliases)}"
+
+    def aggregates(self, table=sentinel_events):
+        # Registry constants are rendered inline; only request filters become bind parameters
+        columns = []
+        for conjunction, alias in self.aliases.items():
+            if conjunction:
+                condition = and_(*(table.c[column] == literal_column(str(int(value))) for column, value in conjunction))
+                columns.append(func.sum(case((condition, literal_column("1")), else_=literal_column("0"))).label(alias))
+            else:
+                columns.append(func.count().label(alias))
+        return columns
+
+    def _value(self, row, conjunction):
+        if conjunction is None:
+            return 0
+        return row[self.aliases[conjunction]]
+
+    def columns(self, name):
+        """(metric field, alias) for each metric of a planned node; alias is None for contradictions."""
+        node = self.nodes[name]
+        return [
+            (METRICS[key].field, self.aliases.get(_conjunction(node.where, {METRICS[key].column: METRICS[key].value})))
+            for key in node.metrics
+        ]
+
+    def node_alias(self, name):
+        return self.aliases[_conjunction(self.nodes[name].where)]
+
+    def tables(self, name, rows, dimension="Gender"):
+        # rows are mappings of the dimension and the plan aliases (SQL rows or snapshot counts)
+        if name not in self.nodes:
+            return []
+        node = self.nodes[name]
+        metrics = [METRICS[key] for key in node.metrics]
+        present = [row for row in rows if self._value(row, _conjunction(node.where))]
+        first = DIMENSION_COLUMNS[dimension]
+        title = node.title if dimension == "Gender" else node.title.replace("Sex", first["headerName"], 1)
+
+        def metric_value(row, metric):
+            return self._value(row, _conjunction(node.where, {metric.column: metric.value}))
+
+        if len(metrics) == 1 and not node.where:
+            metric = metrics[0]
+            return [{
+                "tableTitle": title,
+                "columns": [first, NUMBER_COLUMN],
+                "rows": [{first["field"]: row[dimension], "number": metric_value(row, metric)} for row in present],
+            }]
+
+        return [{
+            "tableTitle": title,
+            "columns": [first] + [
+                {"field": metric.field, "headerName": metric.header, "flex": 1, "minWidth": metric.min_width}
+                for metric in metrics
+            ],
+            "rows": [
+                {first["field"]: row[dimension], **{metric.field: metric_value(row, metric) for metric in metrics}}
+                for row in present
+            ],
+        }]
+
+
+def check_tables():
+    """Validate the table shape of every registry node once, instead of on every response."""
+    adapter = TypeAdapter(List[BreakdownTable])
+    plan = BreakdownPlan(list(NODES) + ["Unregistered node"])
+    for name in plan.nodes:
+        for dimension in DIMENSION_COLUMNS:
+            rows = [{dimension: value, **{alias: 1 for alias in plan.aliases.values()}} for value in ("a", "b")]
+            tables = adapter.validate_python(plan.tables(name, rows, dimension))
+            for table in tables:
+                fields = [column.field for column in table.columns]
+                for row in table.rows:
+                    if list(row) != fields:
+                        raise ValueError(f"Breakdown rows of {name!r} do not match their columns")
+
+
+def window_condition(filters, table=sentinel_events):
+    start, end, end_inclusive = cohort_window(filters)
+    return and_(table.c.CohortYearMonth >= start,
+                table.c.CohortYearMonth <= end if end_inclusive else table.c.CohortYearMonth < end)
+
+
+def dimension_conditions(filters, table=sentinel_events):
+    conditions = []
+    for field, column in FILTER_COLUMNS.items():
+        values = getattr(filters, field)
+        if values:
+            # Expanding IN: one bound parameter per value, never inlined into the SQL text
+            conditions.append(table.c[column].in_(values))
+    return conditions
+
+
+def filter_conditions(filters, table=sentinel_events):
+    return [window_condition(filters, table)] + dimension_conditions(filters, table)
+
+
+def breakdown_statement(plan, filters, dimensions=DEFAULT_DIMENSIONS, dialect="mssql"):
+    """One scan of CsSentinelEvents answering every node in ``plan`` for every breakdown dimension.
+
+    With several dimensions each row also carries a grouping_<dimension> flag, 0 for the
+    dimension the row is grouped by (as GROUPING() returns); see split_rows.
+    """
+    table = sentinel_events
+    columns = [table.c[FILTER_COLUMNS[dimension]].label(dimension) for dimension in dimensions]
+    if len(dimensions) == 1:
+        return select(*columns, *plan.aggregates(table)) \
+            .where(*filter_conditions(filters, table)) \
+            .group_by(*(column.element for column in columns))
+    if dialect in GROUPING_SETS_DIALECTS:
+        flags = [func.grouping(column).label(f"grouping_{dimension}") for dimension, column in zip(dimensions, columns)]
+        return select(*columns, *flags, *plan.aggregates(table)) \
+            .where(*filter_conditions(filters, table)) \
+            .group_by(func.grouping_sets(*(column.element for column in columns)))
+    parts = []
+    for dimension, column in zip(dimensions, columns):
+        grouped = [column if other == dimension else null().label(other) for other in dimensions]
+        flags = [literal_column("0" if other == dimension else "1").label(f"grouping_{other}") for other in dimensions]
+        parts.append(select(*grouped, *flags, *plan.aggregates(table))
+                     .where(*filter_conditions(filters, table))
+                     .group_by(column.element))
+    return union_all(*parts)
+
+
+def split_rows(rows, dimensions=DEFAULT_DIMENSIONS):
+    """{dimension: rows} from the rows of a breakdown_statement."""
+    if len(dimensions) == 1:
+        return {dimensions[0]: rows}
+    split = {dimension: [] for dimension in dimensions}
+    for row in rows:
+        for dimension in dimensions:
+            if not row[f"grouping_{dimension}"]:
+                split[dimension].append(row)
+                break
+    return split
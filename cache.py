@@ -0,0 +1,339 @@
+import asyncio
+import hashlib
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import zlib
+from collections import OrderedDict, Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from models import FILTER_COLUMNS, cohort_window
+from versioning import data_version
+
+try:
+    import redis
+    import redis.asyncio
+except ImportError:  # only needed for CACHE_BACKEND=redis
+    redis = None
+
+SANKEY_CACHE_MAXSIZE = int(os.getenv("SANKEY_CACHE_MAXSIZE", "512"))
+SANKEY_CACHE_TTL = float(os.getenv("SANKEY_CACHE_TTL", "3600"))
+# "memory" keeps results per worker; "sqlite" (a file shared by the workers on a node) and
+# "redis" (shared by every worker that can reach it) let one worker's results serve the others
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "memory").lower()
+CACHE_SQLITE_PATH = os.getenv("CACHE_SQLITE_PATH", os.path.join(tempfile.gettempdir(), "sankey-cache.sqlite"))
+CACHE_SQLITE_MMAP_SIZE = int(os.getenv("CACHE_SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+CACHE_SQLITE_THREADS = int(os.getenv("CACHE_SQLITE_THREADS", "2"))
+CACHE_REDIS_URL = os.getenv("CACHE_REDIS_URL", "redis://localhost:6379/0")
+
+
+def filter_key(filters, *extra):
+    """Canonical, hashable form of a SankeyFilter/SankeyBreakdown.
+
+    List fields are de-duplicated and sorted, empty lists are treated like missing
+    ones and the default cohort window is resolved, so equivalent requests share a key.
+    """
+    key = []
+    for field in FILTER_COLUMNS:
+        values = getattr(filters, field, None) or ()
+        key.append(tuple(sorted(set(values), key=str)))
+    return (*key, *cohort_window(filters), *extra)
+
+
+def normalized_filter(filters):
+    """JSON-friendly counterpart of filter_key, for logs and metrics."""
+    normalized = {}
+    for field in FILTER_COLUMNS:
+        values = getattr(filters, field, None)
+        if values:
+            normalized[field] = sorted(set(values), key=str)
+    start, end, end_inclusive = cohort_window(filters)
+    normalized["CohortYearMonthStart"] = start
+    normalized["CohortYearMonthEnd" if end_inclusive else "CohortYearMonthBefore"] = end
+    return normalized
+
+
+class TTLCache:
+    """Thread-safe LRU cache whose entries also expire after ``ttl`` seconds."""
+
+    def __init__(self, maxsize=SANKEY_CACHE_MAXSIZE, ttl=SANKEY_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires, value = entry
+            if expires <= time.monotonic():
+                del self._data[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+
+class MemoryCache:
+    """Per-worker result cache: a TTLCache behind the same coroutine interface as the shared ones."""
+
+    backend = "memory"
+    shared = False
+
+    def __init__(self, maxsize=SANKEY_CACHE_MAXSIZE, ttl=SANKEY_CACHE_TTL):
+        self.cache = TTLCache(maxsize, ttl)
+
+    async def get(self, key):
+        return self.cache.get(key)
+
+    async def set(self, key, value):
+        self.cache.set(key, value)
+
+    async def clear(self):
+        self.cache.clear()
+
+    def stats(self):
+        return {"backend": self.backend, **self.cache.stats()}
+
+
+class SharedCache:
+    """Base for caches shared between workers.
+
+    Keys are namespaced by the data version, so once the workers see a new version
+    they stop reading what was cached for the old one without having to clear it;
+    the old entries simply expire. Values are bytes, stored zlib-compressed.
+    """
+
+    shared = True
+
+    def __init__(self, namespace, ttl=SANKEY_CACHE_TTL, version=lambda: data_version.version):
+        self.namespace = namespace
+        self.ttl = ttl
+        self.version = version
+        self.size = None
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    def storage_key(self, key):
+        digest = hashlib.blake2b(repr(key).encode(), digest_size=16).hexdigest()
+        return f"{self.namespace}:{self.version()}:{digest}"
+
+    async def get(self, key):
+        try:
+            value = await self._get(self.storage_key(key))
+            if value is not None:
+                value = zlib.decompress(value)
+        except Exception:
+            # An unavailable shared cache or a corrupt entry only costs the query it would have saved
+            self.errors += 1
+            value = None
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return value
+
+    async def set(self, key, value):
+        try:
+            await self._set(self.storage_key(key), zlib.compress(value, 1))
+        except Exception:
+            self.errors += 1
+
+    def stats(self):
+        # No I/O here: size is whatever the backend last observed (None if it cannot tell)
+        return {
+            "backend": self.backend,
+            "size": self.size,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": 0,
+            "errors": self.errors,
+        }
+
+
+# sqlite3 blocks (up to its busy timeout while another worker writes), so the SQLite
+# cache runs on its own threads rather than on the event loop or the DB executor
+cache_executor = ThreadPoolExecutor(max_workers=CACHE_SQLITE_THREADS, thread_name_prefix="cache")
+
+
+class SQLiteCache(SharedCache):
+    """Cache in a memory-mapped SQLite file (WAL mode) shared by the workers on one host."""
+
+    backend = "sqlite"
+
+    def __init__(self, namespace, path=CACHE_SQLITE_PATH, maxsize=SANKEY_CACHE_MAXSIZE, ttl=SANKEY_CACHE_TTL,
+                 **kwargs):
+        super().__init__(namespace, ttl, **kwargs)
+        self.path = path
+        self.maxsize = maxsize
+        self._local = threading.local()
+        self._writes = 0
+        self._connection().execute(
+            "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB NOT NULL, expires REAL NOT NULL)")
+        self._connection().execute("CREATE INDEX IF NOT EXISTS cache_expires ON cache (expires)")
+
+    def _connection(self):
+        # One connection per thread; the file (not the connection) is what the workers share
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute(f"PRAGMA mmap_size={CACHE_SQLITE_MMAP_SIZE}")
+            self._local.connection = connection
+        return connection
+
+    @staticmethod
+    async def _run(fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(cache_executor, fn, *args)
+
+    async def _get(self, key):
+        return await self._run(self._read, key)
+
+    async def _set(self, key, value):
+        await self._run(self._write, key, value)
+
+    async def clear(self):
+        await self._run(self._delete_namespace)
+
+    def _read(self, key):
+        row = self._connection().execute(
+            "SELECT value FROM cache WHERE key = ? AND expires > ?", (key, time.time())).fetchone()
+        return row[0] if row else None
+
+    def _write(self, key, value):
+        connection = self._connection()
+        connection.execute("INSERT OR REPLACE INTO cache (key, value, expires) VALUES (?, ?, ?)",
+                           (key, value, time.time() + self.ttl))
+        self._writes += 1
+        if self._writes % 64 == 0:
+            self._prune(connection)
+
+    def _prune(self, connection):
+        # Expired entries first, then the ones closest to expiry (i.e. the oldest) above maxsize
+        connection.execute("DELETE FROM cache WHERE expires <= ?", (time.time(),))
+        connection.execute(
+            "DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY expires DESC LIMIT -1 OFFSET ?)",
+            (self.maxsize,))
+        self.size = connection.execute("SELECT count(*) FROM cache").fetchone()[0]
+
+    def _delete_namespace(self):
+        connection = self._connection()
+        connection.execute("DELETE FROM cache WHERE key LIKE ?", (f"{self.namespace}:%",))
+        self.size = connection.execute("SELECT count(*) FROM cache").fetchone()[0]
+
+
+class RedisCache(SharedCache):
+    """Cache in Redis (or anything speaking its protocol) through the asyncio client; entries expire with SETEX."""
+
+    backend = "redis"
+
+    def __init__(self, namespace, url=CACHE_REDIS_URL, ttl=SANKEY_CACHE_TTL, **kwargs):
+        if redis is None:
+            raise RuntimeError("CACHE_BACKEND=redis needs the redis package installed")
+        super().__init__(namespace, ttl, **kwargs)
+        self.client = redis.asyncio.Redis.from_url(url, socket_timeout=0.5)
+
+    async def _get(self, key):
+        return await self.client.get(key)
+
+    async def _set(self, key, value):
+        await self.client.setex(key, max(int(self.ttl), 1), value)
+
+    async def clear(self):
+        keys = []
+        async for key in self.client.scan_iter(match=f"{self.namespace}:*", count=500):
+            keys.append(key)
+            if len(keys) == 500:
+                await self.client.unlink(*keys)
+                keys = []
+        if keys:
+            await self.client.unlink(*keys)
+
+
+def create_cache(namespace, backend=CACHE_BACKEND):
+    if backend == "sqlite":
+        return SQLiteCache(namespace)
+    if backend == "redis":
+        return RedisCache(namespace)
+    return MemoryCache()
+
+
+class SingleFlight:
+    """Concurrent calls with the same key share one in-flight query and its result or error.
+
+    Keys start with a kind ("sankey", "breakdown", ...) that the counters are broken down by.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self.leaders = Counter()
+        self.coalesced = Counter()
+
+    async def do(self, key, factory):
+        future = self._calls.get(key)
+        if future is None:
+            self.leaders[key[0]] += 1
+            future = asyncio.ensure_future(factory())
+            self._calls[key] = future
+            future.add_done_callback(lambda done: self._finished(key, done))
+        else:
+            self.coalesced[key[0]] += 1
+        # A waiter that times out or disconnects must not cancel the query others are waiting on
+        return await asyncio.shield(future)
+
+    def _finished(self, key, future):
+        self._calls.pop(key, None)
+        if not future.cancelled():
+            future.exception()  # retrieved here so an error nobody awaited is not reported as lost
+
+    def stats(self):
+        return {
+            "inFlight": len(self._calls),
+            "leaders": dict(self.leaders),
+            "coalesced": dict(self.coalesced),
+        }
+
+
+sankey_cache = create_cache("sankey")
+breakdown_cache = create_cache("breakdown")
+query_flights = SingleFlight()
@@ -0,0 +1,128 @@
+import os
+import zlib
+
+from starlette.datastructures import Headers, MutableHeaders
+
+try:
+    import brotli
+except ImportError:  # brotli is optional; gzip is always available
+    brotli = None
+
+COMPRESSION_MINIMUM_SIZE = int(os.getenv("COMPRESSION_MINIMUM_SIZE", "1024"))
+GZIP_LEVEL = int(os.getenv("GZIP_LEVEL", "6"))
+BROTLI_QUALITY = int(os.getenv("BROTLI_QUALITY", "5"))
+
+
+def supported_encodings():
+    # In order of preference when the client weights them equally
+    return ["br", "gzip"] if brotli is not None else ["gzip"]
+
+
+def negotiate(accept_encoding):
+    """Best supported Content-Encoding for an Accept-Encoding header, or None for identity."""
+    weights = {}
+    for part in accept_encoding.split(","):
+        name, _, params = part.strip().partition(";")
+        weight = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                weight = float(params[2:])
+            except ValueError:
+                weight = 0.0
+        if name:
+            weights[name.strip().lower()] = weight
+    best = None
+    for encoding in supported_encodings():
+        weight = weights.get(encoding, weights.get("*", 0.0))
+        if weight > 0 and (best is None or weight > best[0]):
+            best = (weight, encoding)
+    return best[1] if best else None
+
+
+class _Gzip:
+    def __init__(self):
+        self._compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+    def finish(self):
+        return self._compressor.flush()
+
+
+class _Brotli:
+    def __init__(self):
+        self._compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+
+    def compress(self, data):
+        return self._compressor.process(data)
+
+    def finish(self):
+        return self._compressor.finish()
+
+
+COMPRESSORS = {"gzip": _Gzip, "br": _Brotli}
+
+
+class CompressionMiddleware:
+    """gzip/brotli response compression negotiated per request from Accept-Encoding.
+
+    Small bodies and responses that already carry a Content-Encoding are passed
+    through; streamed bodies are compressed chunk by chunk.
+    """
+
+    def __init__(self, app, minimum_size=COMPRESSION_MINIMUM_SIZE):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        encoding = None
+        if scope["type"] == "http":
+            encoding = negotiate(Headers(scope=scope).get("accept-encoding", ""))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start = None
+        compressor = None
+
+        async def send_compressed(message):
+            nonlocal start, compressor
+            if message["type"] == "http.response.start":
+                # Held back until the first body chunk decides whether to compress
+                start = message
+                return
+            if message["type"] != "http.response.body":
+                await send(message)
+                return
+
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if start is not None:
+                headers = MutableHeaders(raw=start["headers"])
+                headers.add_vary_header("Accept-Encoding")
+                if "content-encoding" not in headers and (more_body or len(body) >= self.minimum_size):
+                    compressor = COMPRESSORS[encoding]()
+                    headers["Content-Encoding"] = encoding
+                    if more_body:
+                        del headers["Content-Length"]
+                        body = compressor.compress(body)
+                    else:
+                        body = compressor.compress(body) + compressor.finish()
+                        headers["Content-Length"] = str(len(body))
+                        compressor = None
+                    message = {**message, "body": body}
+                await send(start)
+                start = None
+                await send(message)
+                return
+
+            if compressor is not None:
+                body = compressor.compress(body)
+                if not more_body:
+                    body += compressor.finish()
+                message = {**message, "body": body}
+            await send(message)
+
+        await self.app(scope, receive, send_compressed)
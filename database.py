@@ -1,18 +1,218 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, exc
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+from instrumentation import instrument_engine, record_rows
+import asyncio
+import contextvars
+import re
+import threading
+import time
 import os
 
-DATABASE_URL = "mssql+pymssql://user:password@ip:port/HIVCaseSurveillance"
+load_dotenv()
 
-engine = create_engine(DATABASE_URL)
+DATABASE_URL = os.getenv("DATABASE_URL", "mssql+pymssql://user:password@ip:port/HIVCaseSurveillance")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() in ("1", "true", "yes")
+# pymssql substitutes parameters client-side, so MSSQL would see literal SQL and compile a
+# plan per filter set; wrapping statements in sp_executesql keeps the text parameterized.
+MSSQL_SP_EXECUTESQL = os.getenv("MSSQL_SP_EXECUTESQL", "true").lower() in ("1", "true", "yes")
+MSSQL_STRING_PARAM_TYPE = os.getenv("MSSQL_STRING_PARAM_TYPE", "varchar(4000)")
+
+
+class PoolMetrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.checkins = 0
+        self.connects = 0
+        self.connection_errors = 0
+        self.checkout_timeouts = 0
+        self.invalidations = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+
+    def record_wait(self, seconds):
+        with self._lock:
+            self.wait_time_total += seconds
+            self.wait_time_max = max(self.wait_time_max, seconds)
+
+    def incr(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def snapshot(self, pool):
+        with self._lock:
+            checkouts = self.checkouts
+            return {
+                "size": pool.size(),
+                "max_overflow": DB_MAX_OVERFLOW,
+                "in_use": pool.checkedout(),
+                "idle": pool.checkedin(),
+                "overflow": max(pool.overflow(), 0),
+                "checkouts": checkouts,
+                "checkins": self.checkins,
+                "connects": self.connects,
+                "connection_errors": self.connection_errors,
+                "checkout_timeouts": self.checkout_timeouts,
+                "invalidations": self.invalidations,
+                "wait_time_total": self.wait_time_total,
+                "wait_time_avg": self.wait_time_total / checkouts if checkouts else 0.0,
+                "wait_time_max": self.wait_time_max,
+            }
+
+
+pool_metrics = PoolMetrics()
+
+
+class InstrumentedQueuePool(QueuePool):
+    # Times how long callers wait for a connection, which the pool events cannot see
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            pool_metrics.incr("checkout_timeouts")
+            raise
+        except Exception:
+            pool_metrics.incr("connection_errors")
+            raise
+        finally:
+            pool_metrics.record_wait(time.perf_counter() - start)
+
+
+engine = create_engine(
+    DATABASE_URL,
+    poolclass=InstrumentedQueuePool,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_timeout=DB_POOL_TIMEOUT,
+    pool_recycle=DB_POOL_RECYCLE,
+    pool_pre_ping=DB_POOL_PRE_PING,
+)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
 
-def get_db():
+@event.listens_for(engine, "connect")
+def _on_connect(dbapi_connection, connection_record):
+    pool_metrics.incr("connects")
+
+
+@event.listens_for(engine, "checkout")
+def _on_checkout(dbapi_connection, connection_record, connection_proxy):
+    pool_metrics.incr("checkouts")
+
+
+@event.listens_for(engine, "checkin")
+def _on_checkin(dbapi_connection, connection_record):
+    pool_metrics.incr("checkins")
+
+
+@event.listens_for(engine, "invalidate")
+def _on_invalidate(dbapi_connection, connection_record, exception):
+    pool_metrics.incr("invalidations")
+
+
+instrument_engine(engine)
+
+
+def pool_status():
+    return pool_metrics.snapshot(engine.pool)
+
+
+def warm_pool(size=DB_POOL_SIZE):
+    """Open ``size`` pooled connections up front, so the first requests do not pay for the logins."""
+    connections = []
+    try:
+        for _ in range(size):
+            connection = engine.connect()
+            connections.append(connection)
+            connection.exec_driver_sql("SELECT 1")
+    finally:
+        for connection in connections:
+            connection.close()
+    return len(connections)
+
+
+# pymssql has no asyncio driver, so blocking DB work runs on an executor sized to the
+# pool. Async handlers then queue here instead of tying up Starlette's shared threadpool.
+db_executor = ThreadPoolExecutor(max_workers=DB_POOL_SIZE + DB_MAX_OVERFLOW, thread_name_prefix="db")
+
+
+_named_dialects = {}
+
+
+def _sql_type(value):
+    if isinstance(value, bool):
+        return "bit"
+    if isinstance(value, int):
+        return "bigint"
+    if isinstance(value, float):
+        return "float"
+    return MSSQL_STRING_PARAM_TYPE
+
+
+def sp_executesql(statement, dialect):
+    """Render ``statement`` as ``EXEC sp_executesql`` with typed @parameters.
+
+    The inner SQL only changes with the shape of the request (which filters are set
+    and how many IN values), so MSSQL can reuse its cached plan across requests.
+    """
+    named = _named_dialects.get(type(dialect))
+    if named is None:
+        named = _named_dialects[type(dialect)] = type(dialect)(paramstyle="named")
+    compiled = statement.compile(dialect=named, compile_kwargs={"render_postcompile": True})
+    params = dict(compiled.params)
+    inner = re.sub(r"(?<![:\w]):(\w+)", r"@\1", compiled.string)
+    declarations = ", ".join(f"@{name} {_sql_type(value)}" for name, value in params.items())
+    sql = f"EXEC sp_executesql N'{inner.replace(chr(39), chr(39) * 2)}'"
+    if params:
+        sql = sql.replace("%", "%%")
+        sql += f", N'{declarations}', " + ", ".join(f"@{name} = %({name})s" for name in params)
+    return sql, params
+
+
+def execute_parameterized(db, statement):
+    connection = db.connection()
+    if connection.dialect.name == "mssql" and MSSQL_SP_EXECUTESQL:
+        rows = connection.exec_driver_sql(*sp_executesql(statement, connection.dialect)).all()
+    else:
+        rows = connection.execute(statement).all()
+    record_rows(connection, len(rows))
+    return rows
+
+
+def stream_parameterized(db, statement, batch_size):
+    """Like execute_parameterized, but yields the rows in batches as they are fetched."""
+    connection = db.connection()
+    options = {"yield_per": batch_size}
+    if connection.dialect.name == "mssql" and MSSQL_SP_EXECUTESQL:
+        result = connection.exec_driver_sql(*sp_executesql(statement, connection.dialect), execution_options=options)
+    else:
+        result = connection.execute(statement, execution_options=options)
+    for rows in result.partitions():
+        record_rows(connection, len(rows))
+        yield rows
+
+
+def _with_session(fn, args):
     db = SessionLocal()
     try:
-        yield db
+        return fn(db, *args)
     finally:
         db.close()
+
+
+async def run_db(fn, *args):
+    """Run ``fn(db, *args)`` with its own session on the DB executor."""
+    loop = asyncio.get_running_loop()
+    # Carry the request context (query instrumentation) into the worker thread
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(db_executor, context.run, _with_session, fn, args)
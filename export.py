@@ -0,0 +1,168 @@
+import csv
+import io
+import os
+import threading
+import weakref
+
+from fastapi import HTTPException
+from sqlalchemy import select, func
+from starlette.responses import StreamingResponse
+
+from breakdown import filter_conditions
+from database import SessionLocal, stream_parameterized
+from models import CaseBreakdown, FILTER_COLUMNS, sentinel_events
+from responses import dumps
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:  # Parquet export is optional
+    pyarrow = None
+
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "5000"))
+# Each export holds a pooled connection for as long as its client reads, so keep this
+# well below DB_POOL_SIZE; further exports are refused with 503 instead of queueing
+EXPORT_CONCURRENCY = int(os.getenv("EXPORT_CONCURRENCY", "2"))
+
+export_slots = threading.BoundedSemaphore(EXPORT_CONCURRENCY)
+
+MEDIA_TYPES = {
+    "csv": "text/csv; charset=utf-8",
+    "ndjson": "application/x-ndjson",
+    "parquet": "application/vnd.apache.parquet",
+}
+
+
+def export_column(table, field):
+    # by= takes filter field names (Agency, Partner, ...) or CohortYearMonth
+    return table.c[FILTER_COLUMNS.get(field, field)]
+
+
+def sankey_export_statement(filters, by):
+    table = CaseBreakdown.__table__
+    dims = [export_column(table, field) for field in by]
+    links = [table.c.ord, table.c.source, table.c.target]
+    return select(*dims, *links, func.sum(table.c.metric).label("weight")) \
+        .where(*filter_conditions(filters, table)) \
+        .group_by(*dims, *links) \
+        .order_by(*dims, table.c.ord, table.c.source, table.c.target)
+
+
+def breakdown_export_statement(plan, filters, by):
+    table = sentinel_events
+    group = [export_column(table, field) for field in by] + [table.c.Gender]
+    return select(*group, *plan.aggregates(table)) \
+        .where(*filter_conditions(filters, table)) \
+        .group_by(*group) \
+        .order_by(*group)
+
+
+def _csv(columns, batches):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    for rows in batches:
+        writer.writerows(rows)
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+
+def _ndjson(columns, batches):
+    for rows in batches:
+        yield b"".join(dumps(dict(zip(columns, row))) + b"\n" for row in rows)
+
+
+class _Sink:
+    # Write-only file object handing the Parquet writer's output back to the generator
+    closed = False
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def write(self, data):
+        data = bytes(data)
+        self.chunks.append(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def _parquet(columns, batches, types):
+    schema = pyarrow.schema([(column, pyarrow.int64() if kind is int else pyarrow.string())
+                             for column, kind in zip(columns, types)])
+    sink = _Sink()
+    writer = pyarrow.parquet.ParquetWriter(sink, schema)
+    try:
+        for rows in batches:
+            # One row group per fetched batch
+            writer.write_table(pyarrow.Table.from_pylist([dict(zip(columns, row)) for row in rows], schema=schema))
+            yield sink.drain()
+    finally:
+        writer.close()
+    yield sink.drain()
+
+
+class _Slot:
+    # One export_slots permit, released exactly once: when the stream ends, or when the
+    # response body is discarded without ever having been read
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._held = True
+
+    def release(self):
+        with self._lock:
+            if self._held:
+                self._held = False
+                export_slots.release()
+
+
+def _batches(statement, transform, batch_size, slot):
+    # Owns its session for as long as the client keeps reading
+    db = SessionLocal()
+    try:
+        for rows in stream_parameterized(db, statement, batch_size):
+            rows = transform(rows)
+            if rows:
+                yield rows
+    finally:
+        db.close()
+        slot.release()
+
+
+def export_response(statement, columns, types, export_format, filename, transform=list,
+                    batch_size=EXPORT_BATCH_SIZE):
+    """Stream ``statement`` as CSV, NDJSON or Parquet, ``batch_size`` rows at a time.
+
+    ``types`` gives str or int per column (for the Parquet schema); ``transform`` maps
+    each fetched batch of rows to output rows.
+    """
+    if export_format == "parquet" and pyarrow is None:
+        raise HTTPException(status_code=501, detail="Parquet export needs pyarrow installed")
+    if not export_slots.acquire(blocking=False):
+        raise HTTPException(status_code=503, detail="Too many exports in progress", headers={"Retry-After": "30"})
+    slot = _Slot()
+    batches = _batches(statement, transform, batch_size, slot)
+    if export_format == "csv":
+        body = _csv(columns, batches)
+    elif export_format == "ndjson":
+        body = _ndjson(columns, batches)
+    else:
+        body = _parquet(columns, batches, types)
+    weakref.finalize(body, slot.release)
+    return StreamingResponse(body, media_type=MEDIA_TYPES[export_format], headers={
+        "Content-Disposition": f'attachment; filename="{filename}.{export_format}"',
+    })
@@ -0,0 +1,108 @@
+import asyncio
+import os
+import threading
+
+from cache import TTLCache, SANKEY_CACHE_TTL
+from database import run_db
+from responses import dumps
+from models import CaseBreakdown
+
+
+def query_pairs(db):
+    return db.query(CaseBreakdown.County, CaseBreakdown.SubCounty).distinct() \
+        .order_by(CaseBreakdown.County, CaseBreakdown.SubCounty).all()
+
+
+def query_subcounties(db):
+    return db.query(CaseBreakdown.SubCounty).filter(CaseBreakdown.SubCounty != None).distinct() \
+        .order_by(CaseBreakdown.SubCounty).all()
+
+
+def query_partners(db):
+    return db.query(CaseBreakdown.PartnerName).filter(CaseBreakdown.PartnerName != None).distinct() \
+        .order_by(CaseBreakdown.PartnerName).all()
+
+
+def query_agencies(db):
+    return db.query(CaseBreakdown.AgencyName).filter(CaseBreakdown.AgencyName != None).distinct() \
+        .order_by(CaseBreakdown.AgencyName).all()
+
+
+FACET_QUERIES = (query_pairs, query_subcounties, query_partners, query_agencies)
+# Serialized facet lists kept per County/SubCounty selection
+FACET_CACHE_MAXSIZE = int(os.getenv("FACET_CACHE_MAXSIZE", "256"))
+
+
+class FacetService:
+    """County/SubCounty hierarchy and partner/agency lists, loaded once per data refresh."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.loaded = False
+        self.counties = []
+        self.subcounties = []
+        self.partners = []
+        self.agencies = []
+        self.subcounties_by_county = {}
+        self.counties_by_subcounty = {}
+        self._encoded = TTLCache(FACET_CACHE_MAXSIZE, SANKEY_CACHE_TTL)
+
+    async def load_async(self):
+        # Each facet query runs on its own pooled connection
+        self.populate(*await asyncio.gather(*(run_db(query) for query in FACET_QUERIES)))
+
+    def populate(self, pairs, subcounties, partners, agencies):
+        subcounties_by_county = {}
+        counties_by_subcounty = {}
+        for county, subcounty in pairs:
+            subcounties_by_county.setdefault(county, set()).add(subcounty)
+            counties_by_subcounty.setdefault(subcounty, set()).add(county)
+
+        with self._lock:
+            self.counties = [county for county in subcounties_by_county if county is not None]
+            self.subcounties = [subcounty[0] for subcounty in subcounties]
+            self.partners = [partner[0] for partner in partners]
+            self.agencies = [agency[0] for agency in agencies]
+            self.subcounties_by_county = subcounties_by_county
+            self.counties_by_subcounty = counties_by_subcounty
+            self._encoded.clear()
+            self.loaded = True
+
+    def invalidate(self):
+        with self._lock:
+            self.loaded = False
+
+    def facets(self, county=None, subcounty=None):
+        with self._lock:
+            counties = self.counties
+            subcounties = self.subcounties
+            # Cascading narrowing: the selected counties restrict the subcounty list and vice versa
+            if county:
+                allowed = set().union(*(self.subcounties_by_county.get(name, ()) for name in county))
+                subcounties = [name for name in subcounties if name in allowed]
+            if subcounty:
+                allowed = set().union(*(self.counties_by_subcounty.get(name, ()) for name in subcounty))
+                counties = [name for name in counties if name in allowed]
+            return {
+                "uniqueCounties": counties,
+                "uniqueSubCounties": subcounties,
+                "uniquePartners": self.partners,
+                "uniqueAgencies": self.agencies,
+            }
+
+    def encoded_facets(self, county=None, subcounty=None):
+        # Serialized facet lists per County/SubCounty selection, reused until the next load.
+        # Unknown names narrow nothing, so they are left out of the key (a selection made only
+        # of unknown names still narrows to nothing, hence the flags).
+        with self._lock:
+            key = (bool(county), frozenset(name for name in county or () if name in self.subcounties_by_county),
+                   bool(subcounty), frozenset(name for name in subcounty or () if name in self.counties_by_subcounty))
+        encoded = self._encoded.get(key)
+        if encoded is None:
+            encoded = {name: dumps(values) for name, values in self.facets(county, subcounty).items()}
+            if self.loaded:
+                self._encoded.set(key, encoded)
+        return encoded
+
+
+facet_service = FacetService()
@@ -0,0 +1,206 @@
+import asyncio
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+
+from sqlalchemy import event
+
+logger = logging.getLogger("sankey.slow")
+
+SLOW_REQUEST_MS = float(os.getenv("SLOW_REQUEST_MS", "1000"))
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class RequestStats:
+    def __init__(self, method, path):
+        self.method = method
+        self.path = path
+        # Replaced by the route template once routing matched; a fixed label otherwise,
+        # so arbitrary 404 paths cannot create new metric series
+        self.endpoint = "unmatched"
+        self.labels = {}
+        self.statements = []
+        self.serialization_time = 0.0
+        self.started = time.perf_counter()
+
+    @property
+    def db_time(self):
+        return sum(statement["duration"] for statement in self.statements)
+
+    @property
+    def rows(self):
+        return sum(statement["rows"] or 0 for statement in self.statements)
+
+
+current_request = contextvars.ContextVar("current_request", default=None)
+
+
+def start_background(coroutine):
+    """Task for work not done on behalf of the current request, run in an empty context
+    so its statements are not charged to (and logged with) that request."""
+    return asyncio.get_running_loop().create_task(coroutine, context=contextvars.Context())
+
+
+def annotate(**labels):
+    """Attach request details (normalized filter, node, ...) to the metrics and slow log."""
+    stats = current_request.get()
+    if stats is not None:
+        stats.labels.update(labels)
+
+
+def record_rows(connection, count):
+    # Rows are only known once a result is materialized, after the cursor event fired
+    statement = connection.info.get("last_statement")
+    if statement is not None:
+        statement["rows"] = count
+
+
+def record_serialization(seconds):
+    stats = current_request.get()
+    if stats is not None:
+        stats.serialization_time += seconds
+
+
+class Histogram:
+    def __init__(self, buckets=DURATION_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.count += 1
+        self.total += value
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.endpoints = {}
+
+    def observe(self, stats, duration, status):
+        with self._lock:
+            endpoint = self.endpoints.setdefault((stats.method, stats.endpoint), {
+                "requests": 0, "errors": 0, "slow": 0, "statements": 0, "rows": 0, "db_time": 0.0,
+                "serialization_time": 0.0, "duration": Histogram(), "statement_duration": Histogram(),
+            })
+            endpoint["requests"] += 1
+            endpoint["errors"] += status >= 500
+            endpoint["slow"] += duration * 1000 >= SLOW_REQUEST_MS
+            endpoint["statements"] += len(stats.statements)
+            endpoint["rows"] += stats.rows
+            endpoint["db_time"] += stats.db_time
+            endpoint["serialization_time"] += stats.serialization_time
+            endpoint["duration"].observe(duration)
+            for statement in stats.statements:
+                endpoint["statement_duration"].observe(statement["duration"])
+
+    def render(self, gauges=()):
+        lines = []
+
+        def family(name, kind, help_text):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        with self._lock:
+            endpoints = sorted(self.endpoints.items())
+            counters = [
+                ("sankey_requests_total", "requests", "HTTP requests handled"),
+                ("sankey_request_errors_total", "errors", "HTTP requests that returned 5xx"),
+                ("sankey_slow_requests_total", "slow", "Requests slower than SLOW_REQUEST_MS"),
+                ("sankey_db_statements_total", "statements", "SQL statements executed"),
+                ("sankey_db_rows_total", "rows", "Rows returned by SQL statements"),
+                ("sankey_db_seconds_total", "db_time", "Time spent executing SQL statements"),
+                ("sankey_serialization_seconds_total", "serialization_time", "Time spent rendering responses"),
+            ]
+            for name, field, help_text in counters:
+                family(name, "counter", help_text)
+                for (method, path), endpoint in endpoints:
+                    lines.append(f'{name}{{method="{method}",endpoint="{path}"}} {endpoint[field]}')
+            for name, field, help_text in [
+                ("sankey_request_duration_seconds", "duration", "Request latency"),
+                ("sankey_db_statement_duration_seconds", "statement_duration", "SQL statement latency"),
+            ]:
+                family(name, "histogram", help_text)
+                for (method, path), endpoint in endpoints:
+                    histogram = endpoint[field]
+                    labels = f'method="{method}",endpoint="{path}"'
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {count}')
+                    lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {histogram.count}')
+                    lines.append(f"{name}_sum{{{labels}}} {histogram.total}")
+                    lines.append(f"{name}_count{{{labels}}} {histogram.count}")
+
+        for name, value, help_text in gauges:
+            if value is None:
+                # Not known, e.g. the size of a cache kept in Redis
+                continue
+            family(name, "gauge", help_text)
+            lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+def instrument_engine(engine):
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("statement_started", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info["statement_started"].pop()
+        stats = current_request.get()
+        conn.info["last_statement"] = None
+        if stats is not None:
+            rowcount = cursor.rowcount if cursor.rowcount is not None and cursor.rowcount >= 0 else None
+            entry = {
+                "duration": time.perf_counter() - started,
+                "rows": rowcount,
+                "sql": " ".join(statement.split())[:500],
+            }
+            stats.statements.append(entry)
+            conn.info["last_statement"] = entry
+
+
+async def instrumentation_middleware(request, call_next):
+    stats = RequestStats(request.method, request.url.path)
+    token = current_request.set(stats)
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        current_request.reset(token)
+        route = request.scope.get("route")
+        if route is not None:
+            stats.endpoint = route.path
+        duration = time.perf_counter() - stats.started
+        metrics.observe(stats, duration, status)
+        if duration * 1000 >= SLOW_REQUEST_MS:
+            logger.warning(json.dumps({
+                "event": "slow_request",
+                "method": stats.method,
+                "endpoint": stats.endpoint,
+                "path": stats.path,
+                "status": status,
+                "duration_ms": round(duration * 1000, 2),
+                "db_ms": round(stats.db_time * 1000, 2),
+                "serialization_ms": round(stats.serialization_time * 1000, 2),
+                "statement_count": len(stats.statements),
+                "rows": stats.rows,
+                **stats.labels,
+                "statements": [
+                    {"duration_ms": round(statement["duration"] * 1000, 2), "rows": statement["rows"],
+                     "sql": statement["sql"]}
+                    for statement in stats.statements
+                ],
+            }, default=str))
@@ -1,23 +1,54 @@
 from pathlib import Path
-from typing import Union
+from typing import Union, Optional, List, Dict, Annotated
 
 from annotated_types.test_cases import Case
-from sqlalchemy.sql import text
-from fastapi import FastAPI, Depends, Request
+from fastapi import FastAPI, Depends, Request, Header, HTTPException, Query
+from fastapi.responses import PlainTextResponse, Response
 from sqlalchemy import func
 from starlette.middleware.cors import CORSMiddleware
 
-from database import get_db
-from sqlalchemy.orm import Session
-from models import CaseBreakdown, SankeyFilter, SankeyBreakdown
-
+from database import run_db, pool_status, execute_parameterized, warm_pool, db_executor
+from models import CaseBreakdown, SankeyFilter, SankeyFilterQuery, SankeyBreakdown, SankeyBreakdownBatch, \
+    SankeyBatch, DEFAULT_COHORT_START, DEFAULT_COHORT_END, SankeyResponse, SankeyBatchResponse, SankeyFacets, \
+    BreakdownTable, SankeyExport, BreakdownExport
+from batch import plan_groups, query_grouped_flows
+from advisor import advise, ADVISOR_REPLAY_LIMIT, INDEX_ADVISOR_APPLY
+from export import export_response, sankey_export_statement, breakdown_export_statement
+from breakdown import BreakdownPlan, NODES, DEFAULT_DIMENSIONS, breakdown_statement, split_rows, check_tables
+from cache import sankey_cache, breakdown_cache, query_flights, filter_key, normalized_filter
+from facets import facet_service
+from rollup import rollup_cube, event_rollups
+from instrumentation import instrumentation_middleware, annotate, metrics
+from responses import FastJSONResponse, dumps, json_object
+from compression import CompressionMiddleware
+from versioning import data_version, etag, matches, cache_headers
+from warmup import RefreshWatcher, Readiness, request_log, warm_all, WARM_TOP_FILTERS
+from snapshot import sankey_snapshot, events_snapshot, SANKEY_ENGINE, BREAKDOWN_ENGINE
+
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+import os
 import pandas as pd
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 
-app = FastAPI()
+
+
+@asynccontextmanager
+async def lifespan(app):
+    readiness.start()
+    refresh_watcher.start()
+    yield
+    await readiness.stop()
+    await refresh_watcher.stop()
+
+
+app = FastAPI(default_response_class=FastJSONResponse, lifespan=lifespan)
 # Base.metadata.create_all(bind=engine)
 
+app.middleware("http")(instrumentation_middleware)
+app.add_middleware(CompressionMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -29,8 +60,251 @@ app.add_middleware(
 
 # app.mount("/{rest_of_path: path}/{rest_of_path2: path}", StaticFiles(directory="build", html=True), name="static")
 
-@app.post("/sankey-data/")
-def get_sankey_data(filters: SankeyFilter, db: Session = Depends(get_db)):
+logger = logging.getLogger(__name__)
+
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+# Local development only: serve /admin/* without a token when ADMIN_TOKEN is unset
+ADMIN_ROUTES_OPEN = os.getenv("ADMIN_ROUTES_OPEN", "false").lower() in ("1", "true", "yes")
+SANKEY_QUERY_TIMEOUT = float(os.getenv("SANKEY_QUERY_TIMEOUT", "60"))
+# Opt-in columnar sankeyData, requested with ?format=compact or this Accept media type
+COMPACT_MEDIA_TYPE = "application/vnd.sankey.compact+json"
+
+check_tables()
+
+
+def require_admin(x_admin_token: Optional[str] = Header(None)):
+    if not ADMIN_TOKEN:
+        if ADMIN_ROUTES_OPEN:
+            return
+        raise HTTPException(status_code=403, detail="Admin routes are disabled; set ADMIN_TOKEN")
+    if x_admin_token != ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Invalid admin token")
+
+
+async def gather_queries(**queries):
+    # Independent queries run concurrently on separate pooled connections; each result is
+    # either its value or the exception it raised (including the per-request timeout).
+    results = await asyncio.gather(
+        *(asyncio.wait_for(query, SANKEY_QUERY_TIMEOUT) for query in queries.values()),
+        return_exceptions=True
+    )
+    return dict(zip(queries, results))
+
+
+async def in_memory_flows(filters):
+    # Flows answered without an aggregate query, or None when the base table is needed
+    if SANKEY_ENGINE == "snapshot":
+        try:
+            await asyncio.wait_for(sankey_snapshot.ensure_loaded(), SANKEY_QUERY_TIMEOUT)
+            return sankey_snapshot.flows(filters)
+        except Exception:
+            logger.exception("Sankey snapshot unavailable, querying the database")
+            return None
+    rollup_cube.ensure_building()
+    if rollup_cube.loaded:
+        return rollup_cube.flows(filters)
+    return None
+
+
+def compact_flows(flows):
+    """Node dictionary plus parallel sourceIdx/targetIdx/weight arrays."""
+    nodes = {}
+    for flow in flows:
+        nodes.setdefault(flow["from"], len(nodes))
+        nodes.setdefault(flow["to"], len(nodes))
+    return {
+        "nodes": list(nodes),
+        "sourceIdx": [nodes[flow["from"]] for flow in flows],
+        "targetIdx": [nodes[flow["to"]] for flow in flows],
+        "weight": [flow["weight"] for flow in flows],
+    }
+
+
+def encode_flows(flows, compact):
+    return dumps(compact_flows(flows) if compact else flows)
+
+
+async def validators(request, *parts):
+    """ETag of the response for the current data version, and whether the client's copy is current."""
+    version = await data_version.ensure_loaded()
+    if version is None:
+        return None, False
+    tag = etag(version, request.url.path, *parts)
+    return tag, matches(request.headers.get("if-none-match"), tag)
+
+
+def not_modified(tag, vary=None):
+    # Same Vary as the full response, so caches match the 304 to the right representation
+    headers = cache_headers(tag)
+    if vary:
+        headers["Vary"] = vary
+    return Response(status_code=304, headers=headers)
+
+
+# Endpoints return FastJSONResponse directly, so response_model only documents the shape.
+# Each POST endpoint has a GET form taking the same filters from the query string, so
+# browsers and proxies can cache and revalidate them.
+@app.post("/sankey-data/", response_model=SankeyResponse)
+async def get_sankey_data(request: Request, filters: SankeyFilter,
+                          response_format: Optional[str] = Query(None, alias="format", pattern="^(links|compact)$")):
+    return await sankey_response(request, filters, response_format)
+
+
+@app.get("/sankey-data/", response_model=SankeyResponse)
+async def get_sankey_data_query(request: Request, filters: Annotated[SankeyFilterQuery, Query()]):
+    return await sankey_response(request, filters, filters.format)
+
+
+def negotiated_format(request, response_format):
+    if response_format is None:
+        accept = request.headers.get("accept", "")
+        return "compact" if COMPACT_MEDIA_TYPE in accept else "links"
+    return response_format
+
+
+async def cached_flows(filters, response_format):
+    # Encoded flows from the result cache or the in-memory engines, or None when SQL is needed.
+    # The cache holds the flows already serialized, so hits skip encoding entirely.
+    key = filter_key(filters, response_format)
+    sankey_data = await sankey_cache.get(key)
+    if sankey_data is None:
+        flows = await in_memory_flows(filters)
+        if flows is not None:
+            sankey_data = encode_flows(flows, response_format == "compact")
+            await sankey_cache.set(key, sankey_data)
+    return sankey_data
+
+
+def checked_flows(result):
+    if isinstance(result, TimeoutError):
+        raise HTTPException(status_code=504, detail="Sankey query timed out")
+    if isinstance(result, Exception):
+        logger.error("Sankey flow query failed", exc_info=result)
+        raise HTTPException(status_code=503, detail="Sankey query failed")
+    return result
+
+
+def facets_failed(response, results):
+    # The flows are still usable without the filter lists, but not worth revalidating
+    if isinstance(results.get("facets"), Exception):
+        logger.warning("Facet queries failed", exc_info=results["facets"])
+        response["errors"] = dumps(["facets"])
+        return True
+    return False
+
+
+async def sankey_response(request, filters, response_format):
+    response_format = negotiated_format(request, response_format)
+    compact = response_format == "compact"
+    annotate(filter=normalized_filter(filters), format=response_format)
+    key = filter_key(filters, response_format)
+    request_log.record(key, filters, response_format)
+    tag, fresh = await validators(request, key)
+    if fresh:
+        return not_modified(tag, vary="Accept")
+
+    sankey_data = await cached_flows(filters, response_format)
+
+    # Identical concurrent requests share one flow query (keyed without the format) and one facet load
+    queries = {}
+    if sankey_data is None:
+        queries["flows"] = query_flights.do(("sankey", *filter_key(filters)),
+                                            lambda: run_db(query_sankey_flows, filters))
+    if not facet_service.loaded:
+        queries["facets"] = query_flights.do(("facets",), facet_service.load_async)
+    results = await gather_queries(**queries)
+
+    if sankey_data is None:
+        sankey_data = encode_flows(checked_flows(results["flows"]), compact)
+        await sankey_cache.set(key, sankey_data)
+
+    response = {"sankeyData": sankey_data, **facet_service.encoded_facets(filters.County, filters.SubCounty)}
+    if facets_failed(response, results):
+        tag = None
+    return FastJSONResponse(json_object(**response), media_type=COMPACT_MEDIA_TYPE if compact else None,
+                            headers={"Vary": "Accept", **cache_headers(tag)})
+
+
+@app.post("/sankey-data/batch", response_model=SankeyBatchResponse)
+async def get_sankey_data_batch(request: Request, batch: SankeyBatch,
+                                response_format: Optional[str] = Query(None, alias="format",
+                                                                       pattern="^(links|compact)$")):
+    """Several filter sets (e.g. one per compared county) in one response, in request order.
+
+    Series are served from the cache and rollups where possible; the rest are grouped
+    by the one dimension they differ in and each group is answered by a single scan.
+    """
+    response_format = negotiated_format(request, response_format)
+    compact = response_format == "compact"
+    keys = [filter_key(filters) for filters in batch.filters]
+    annotate(filters=[normalized_filter(filters) for filters in batch.filters], format=response_format)
+    tag, fresh = await validators(request, tuple(keys), response_format)
+    if fresh:
+        return not_modified(tag, vary="Accept")
+
+    encoded = {}
+    pending = {}
+    for key, filters in zip(keys, batch.filters):
+        if key in encoded or key in pending:
+            continue
+        request_log.record(filter_key(filters, response_format), filters, response_format)
+        sankey_data = await cached_flows(filters, response_format)
+        if sankey_data is None:
+            pending[key] = filters
+        else:
+            encoded[key] = sankey_data
+
+    groups = plan_groups(list(pending.values()))
+    queries = {}
+    for index, (field, members) in enumerate(groups):
+        if field is None:
+            queries[f"group{index}"] = query_flights.do(
+                ("sankey", *filter_key(members[0])), lambda filters=members[0]: run_db(query_sankey_flows, filters))
+        else:
+            queries[f"group{index}"] = query_flights.do(
+                ("sankey-batch", field, *(filter_key(member) for member in members)),
+                lambda field=field, members=members: run_db(query_grouped_flows, field, members))
+    if not facet_service.loaded:
+        queries["facets"] = query_flights.do(("facets",), facet_service.load_async)
+    results = await gather_queries(**queries)
+
+    for index, (field, members) in enumerate(groups):
+        flows = checked_flows(results[f"group{index}"])
+        for member, member_flows in zip(members, [flows] if field is None else flows):
+            sankey_data = encode_flows(member_flows, compact)
+            await sankey_cache.set(filter_key(member, response_format), sankey_data)
+            encoded[filter_key(member)] = sankey_data
+
+    # Facets are the same for every series, so they are sent once, unnarrowed
+    series = b"[" + b",".join(json_object(sankeyData=encoded[key]) for key in keys) + b"]"
+    response = {"series": series, **facet_service.encoded_facets()}
+    if facets_failed(response, results):
+        tag = None
+    return FastJSONResponse(json_object(**response), media_type=COMPACT_MEDIA_TYPE if compact else None,
+                            headers={"Vary": "Accept", **cache_headers(tag)})
+
+
+@app.post("/sankey-data/facets", response_model=SankeyFacets)
+async def get_sankey_facets(request: Request, filters: SankeyFilter):
+    return await facets_response(request, filters)
+
+
+@app.get("/sankey-data/facets", response_model=SankeyFacets)
+async def get_sankey_facets_query(request: Request, filters: Annotated[SankeyFilter, Query()]):
+    return await facets_response(request, filters)
+
+
+async def facets_response(request, filters):
+    tag, fresh = await validators(request, filter_key(filters))
+    if fresh:
+        return not_modified(tag)
+    if not facet_service.loaded:
+        await asyncio.wait_for(query_flights.do(("facets",), facet_service.load_async), SANKEY_QUERY_TIMEOUT)
+    return FastJSONResponse(json_object(**facet_service.encoded_facets(filters.County, filters.SubCounty)),
+                            headers=cache_headers(tag))
+
+
+def query_sankey_flows(db, filters):
     query = db.query(
         CaseBreakdown.ord,
         CaseBreakdown.source,
@@ -53,886 +327,282 @@ def get_sankey_data(filters: SankeyFilter, db: Session = Depends(get_db)):
     if filters.CohortYearMonthStart:
         query = query.filter(CaseBreakdown.CohortYearMonth >= filters.CohortYearMonthStart)
     else:
-        query = query.filter(CaseBreakdown.CohortYearMonth >= '2023-01-01')
+        query = query.filter(CaseBreakdown.CohortYearMonth >= DEFAULT_COHORT_START)
     if filters.CohortYearMonthEnd:
         query = query.filter(CaseBreakdown.CohortYearMonth <= filters.CohortYearMonthEnd)
     else:
-        query = query.filter(CaseBreakdown.CohortYearMonth < '2024-01-01')
+        query = query.filter(CaseBreakdown.CohortYearMonth < DEFAULT_COHORT_END)
 
     query = query.group_by(CaseBreakdown.ord, CaseBreakdown.source, CaseBreakdown.target).order_by(CaseBreakdown.ord)
-    data = query.all()
+    data = execute_parameterized(db, query.statement)
 
     # Transforming the data for Highcharts Sankey
     sankey_data = [
         {"from": record.source, "to": record.target, "weight": record.total_metric}
         for record in data
     ]
-
-
-    # Get unique values for counties, subcounties, partners, and agencies
-    unique_counties_query = db.query(CaseBreakdown.County).filter(CaseBreakdown.County != None).distinct().order_by(CaseBreakdown.County)
-    unique_subcounties_query = db.query(CaseBreakdown.SubCounty).filter(CaseBreakdown.SubCounty != None).distinct().order_by(CaseBreakdown.SubCounty)
-    unique_partners = db.query(CaseBreakdown.PartnerName).filter(CaseBreakdown.PartnerName != None).distinct().order_by(CaseBreakdown.PartnerName).all()
-    unique_agencies = db.query(CaseBreakdown.AgencyName).filter(CaseBreakdown.AgencyName != None).distinct().order_by(CaseBreakdown.AgencyName).all()
-
-    if filters.County:
-        unique_subcounties_query = unique_subcounties_query.filter(CaseBreakdown.County.in_(filters.County))
-    if filters.SubCounty:
-        unique_counties_query = unique_counties_query.filter(CaseBreakdown.SubCounty.in_(filters.SubCounty))
-
-    unique_counties = unique_counties_query.all()
-    unique_subcounties = unique_subcounties_query.all()
-
-    return {
-        "sankeyData": sankey_data,
-        "uniqueCounties": [county[0] for county in unique_counties],
-        "uniqueSubCounties": [subcounty[0] for subcounty in unique_subcounties],
-        "uniquePartners": [partner[0] for partner in unique_partners],
-        "uniqueAgencies": [agency[0] for agency in unique_agencies]
-    }
-
-
-@app.post("/sankey-data/breakdown")
-def sankey_data_breakdown(node: SankeyBreakdown, db: Session = Depends(get_db)):
-    result = []  # List to hold multiple tables
-    filters = []
-    filter_string = ""
-    if node.Partner:
-        filters.append(f"PartnerName IN {format_sql_in_clause(node.Partner)}")
-    if node.Agency:
-        filters.append(f"AgencyName IN {format_sql_in_clause(node.Agency)}")
-    if node.County:
-        filters.append(f"County IN {format_sql_in_clause(node.County)}")
-    if node.SubCounty:
-        filters.append(f"SubCounty IN {format_sql_in_clause(node.SubCounty)}")
-    if node.Gender:
-        filters.append(f"Gender IN {format_sql_in_clause(node.Gender)}")
-    if node.AgeGroup:
-        filters.append(f"AgeGroup IN {format_sql_in_clause(node.AgeGroup)}")
-
-    # Combine filters with base query
-    if filters:
-        filter_string += " AND " + " AND ".join(filters)
-    print(filter_string)
-
-    if node.node in ['Total Cases Reported']:
-        query2 = f"""
-        SELECT 
-            Gender,
-            SUM(LinkedToART) AS Linked,
-            SUM(NotLinkedOnART) AS NotLinked,
-            SUM(WithoutBaselineCD4) AS InitialCD4Done,
-            SUM(WithBaselineCD4) AS InitialCD4NotDone,
-            SUM(AHD) AS WithAHD,
-            SUM(CASE WHEN AHD = 0 THEN 1 ELSE 0 END) AS  WithoutAHD,
-            SUM(NotStaged) AS NotStaged,
-            SUM(WithInitialViralLoad) AS InitialViralLoadDone,
-            SUM(WithoutInitialViralLoad) AS InitialViralLoadNotDone,
-            SUM(IsSuppressedInitialViralload) AS InitialViralLoadSuppressed,
-            SUM(IIF(CsSentinelEvents.IsSuppressedInitialViralload = 0, 1, 0)) AS InitialViralLoadUnsuppressed,
-            SUM(RegimenChanged) AS RegimenChangeDone,
-            SUM(RegimenNotChanged) AS RegimenChangeNotDone,
-            SUM(LatestVLSuppressed) AS LatestVLSuppressed,
-            SUM(LatestVLNotSuppressed) AS LatestVLUnsuppressed,
-            SUM(PatientRetained) AS PatientsRetained,
-            SUM(PatientNotRetained) AS PatientsNotRetained
-        FROM CsSentinelEvents
-        WHERE CohortYearMonth >= '{node.CohortYearMonthStart}' and CohortYearMonth <= '{node.CohortYearMonthEnd}' {filter_string}
-        GROUP BY Gender
-        """
-        data2 = db.execute(text(query2)).fetchall()
-
-        result.append({
-            "tableTitle": f"Sex Distribution For Followup Events",
-            "columns": [
-                {"field": "gender", "headerName": "Sex", "flex": 1, "minWidth": 100},
-                {"field": "linked", "headerName": "Linked", "flex": 1, "minWidth": 100},
-                {"field": "notLinked", "headerName": "Not Linked", "flex": 1, "minWidth": 100},
-                {"field": "initialCD4Done", "headerName": "Initial CD4 Done", "flex": 1, "minWidth": 150},
-                {"field": "initialCD4NotDone", "headerName": "Initial CD4 Not Done", "flex": 1, "minWidth": 150},
-                {"field": "withAHD", "headerName": "With AHD", "flex": 1, "minWidth": 100},
-                {"field": "WithoutAHD", "headerName": "Without AHD", "flex": 1, "minWidth": 100},
-                {"field": "NotStaged", "headerName": "Not Staged", "flex": 1, "minWidth": 100},
-                {"field": "InitialViralLoadDone", "headerName": "Initial Viral Load Done", "flex": 1, "minWidth": 150},
-                {"field": "InitialViralLoadNotDone", "headerName": "Initial Viral Load Not Done", "flex": 1, "minWidth": 150},
-                {"field": "InitialViralLoadSuppressed", "headerName": "Initial Viral Load Suppressed", "flex": 1, "minWidth": 150},
-                {"field": "InitialViralLoadUnsuppressed", "headerName": "Initial Viral Load Unsuppressed", "flex": 1, "minWidth": 150},
-                {"field": "RegimenChangeDone", "headerName": "Regimen Change Done", "flex": 1, "minWidth": 150},
-                {"field": "RegimenChangeNotDone", "headerName": "Regimen Change Not Done", "flex": 1, "minWidth": 150},
-                {"field": "LatestVLSuppressed", "headerName": "Latest VL Suppressed", "flex": 1, "minWidth": 150},
-                {"field": "LatestVLUnsuppressed", "headerName": "Latest VL Unsuppressed", "flex": 1, "minWidth": 150},
-                {"field": "PatientsRetained", "headerName": "Patients Retained", "flex": 1, "minWidth": 150},
-                {"field": "PatientsNotRetained", "headerName": "Patients Not Retained", "flex": 1, "minWidth": 150},
-            ],
-            "rows": [{
-                "gender": row.Gender,
-                "linked": row.Linked,
-                "notLinked": row.NotLinked,
-                "initialCD4Done": row.InitialCD4Done,
-                "initialCD4NotDone": row.InitialCD4NotDone,
-                "withAHD": row.WithAHD,
-                "WithoutAHD": row.WithoutAHD,
-                "NotStaged": row.NotStaged,
-                "InitialViralLoadDone": row.InitialViralLoadDone,
-                "InitialViralLoadNotDone": row.InitialViralLoadNotDone,
-                "InitialViralLoadSuppressed": row.InitialViralLoadSuppressed,
-                "InitialViralLoadUnsuppressed": row.InitialViralLoadUnsuppressed,
-                "RegimenChangeDone": row.RegimenChangeDone,
-                "RegimenChangeNotDone": row.RegimenChangeNotDone,
-                "LatestVLSuppressed": row.LatestVLSuppressed,
-                "LatestVLUnsuppressed": row.LatestVLUnsuppressed,
-                "PatientsRetained": row.PatientsRetained,
-                "PatientsNotRetained": row.PatientsNotRetained,
-            } for row in data2]
-        })
-
-    elif node.node in ['Linked']:
-        query2 = f"""
-        SELECT 
-            Gender,
-            SUM(LinkedToART) AS Linked,
-            SUM(WithoutBaselineCD4) AS InitialCD4Done,
-            SUM(WithBaselineCD4) AS InitialCD4NotDone,
-            SUM(AHD) AS WithAHD,
-            SUM(CASE WHEN AHD = 0 THEN 1 ELSE 0 END) AS  WithoutAHD,
-            SUM(NotStaged) AS NotStaged,
-            SUM(WithInitialViralLoad) AS InitialViralLoadDone,
-            SUM(WithoutInitialViralLoad) AS InitialViralLoadNotDone,
-            SUM(IsSuppressedInitialViralload) AS InitialViralLoadSuppressed,
-            SUM(IIF(CsSentinelEvents.IsSuppressedInitialViralload = 0, 1, 0)) AS InitialViralLoadUnsuppressed,
-            SUM(RegimenChanged) AS RegimenChangeDone,
-            SUM(RegimenNotChanged) AS RegimenChangeNotDone,
-            SUM(LatestVLSuppressed) AS LatestVLSuppressed,
-            SUM(LatestVLNotSuppressed) AS LatestVLUnsuppressed,
-            SUM(PatientRetained) AS PatientsRetained,
-            SUM(PatientNotRetained) AS PatientsNotRetained
-        FROM CsSentinelEvents
-        WHERE LinkedToART = 1 and CohortYearMonth >= '{node.CohortYearMonthStart}' and CohortYearMonth <= '{node.CohortYearMonthEnd}' {filter_string}
-        GROUP BY Gender
-        """
-        data2 = db.execute(text(query2)).fetchall()
-
-        result.append({
-            "tableTitle": f"Sex Distribution For Followup Events",
-            "columns": [
-                {"field": "gender", "headerName": "Sex", "flex": 1, "minWidth": 100},
-                {"field": "linked", "headerName": "Linked", "flex": 1, "minWidth": 100},
-                {"field": "initialCD4Done", "headerName": "Initial CD4 Done", "flex": 1, "minWidth": 100},
-                {"field": "initialCD4NotDone", "headerName": "Initial CD4 Not Done", "flex": 1, "minWidth": 100},
-                {"field": "withAHD", "headerName": "With AHD", "flex": 1, "minWidth": 100},
-                {"field": "WithoutAHD", "headerName": "Without AHD", "flex": 1, "minWidth": 100},
-                {"field": "NotStaged", "headerName": "Not Staged", "flex": 1, "minWidth": 100},
-                {"field": "InitialViralLoadDone", "headerName": "Initial Viral Load Done", "flex": 1, "minWidth": 100},
-                {"field": "InitialViralLoadNotDone", "headerName": "Initial Viral Load Not Done", "flex": 1, "minWidth": 100},
-                {"field": "InitialViralLoadSuppressed", "headerName": "Initial Viral Load Suppressed", "flex": 1, "minWidth": 100},
-                {"field": "InitialViralLoadUnsuppressed", "headerName": "Initial Viral Load Unsuppressed", "flex": 1, "minWidth": 100},
-                {"field": "RegimenChangeDone", "headerName": "Regimen Change Done", "flex": 1, "minWidth": 100},
-                {"field": "RegimenChangeNotDone", "headerName": "Regimen Change Not Done", "flex": 1, "minWidth": 100},
-                {"field": "LatestVLSuppressed", "headerName": "Latest VL Suppressed", "flex": 1, "minWidth": 100},
-                {"field": "LatestVLUnsuppressed", "headerName": "Latest VL Unsuppressed", "flex": 1, "minWidth": 100},
-                {"field": "PatientsRetained", "headerName": "Patients Retained", "flex": 1, "minWidth": 100},
-                {"field": "PatientsNotRetained", "headerName": "Patients Not Retained", "flex": 1, "minWidth": 100},
-            ],
-            "rows": [{
-                "gender": row.Gender,
-                "linked": row.Linked,
-                "initialCD4Done": row.InitialCD4Done,
-                "initialCD4NotDone": row.InitialCD4NotDone,
-                "withAHD": row.WithAHD,
-                "WithoutAHD": row.WithoutAHD,
-                "NotStaged": row.NotStaged,
-                "InitialViralLoadDone": row.InitialViralLoadDone,
-                "InitialViralLoadNotDone": row.InitialViralLoadNotDone,
-                "InitialViralLoadSuppressed": row.InitialViralLoadSuppressed,
-                "InitialViralLoadUnsuppressed": row.InitialViralLoadUnsuppressed,
-                "RegimenChangeDone": row.RegimenChangeDone,
-                "RegimenChangeNotDone": row.RegimenChangeNotDone,
-                "LatestVLSuppressed": row.LatestVLSuppressed,
-                "LatestVLUnsuppressed": row.LatestVLUnsuppressed,
-                "PatientsRetained": row.PatientsRetained,
-                "PatientsNotRetained": row.PatientsNotRetained,
-            } for row in data2]
-        })
-
-    elif node.node in ['Initial CD4 Not Done']:
-
-        query2 = f"""
-        SELECT 
-            Gender,
-            SUM(WithoutBaselineCD4) AS InitialCD4NotDone,
-            SUM(WithInitialViralLoad) AS InitialViralLoadDone,
-            SUM(WithoutInitialViralLoad) AS InitialViralLoadNotDone,
-            SUM(IsSuppressedInitialViralload) AS InitialViralLoadSuppressed,
-            SUM(IIF(CsSentinelEvents.IsSuppressedInitialViralload = 0, 1, 0)) AS InitialViralLoadUnsuppressed,
-            SUM(RegimenChanged) AS RegimenChangeDone,
-            SUM(RegimenNotChanged) AS RegimenChangeNotDone,
-            SUM(LatestVLSuppressed) AS LatestVLSuppressed,
-            SUM(LatestVLNotSuppressed) AS LatestVLUnsuppressed,
-            SUM(PatientRetained) AS PatientsRetained,
-            SUM(PatientNotRetained) AS PatientsNotRetained
-        FROM CsSentinelEvents
-        WHERE LinkedToART = 1 and WithoutBaselineCD4 = 1 and CohortYearMonth >= '{node.CohortYearMonthStart}' and CohortYearMonth <= '{node.CohortYearMonthEnd}' {filter_string}
-        GROUP BY Gender
-        """
-        data2 = db.execute(text(query2)).fetchall()
-
-        result.append({
-            "tableTitle": f"Sex Distribution For Followup Events",
-            "columns": [
-                {"field": "gender", "headerName": "Sex", "flex": 1, "minWidth": 100},
-                {"field": "initialCD4NotDone", "headerName": "Initial CD4 Not Done", "flex": 1, "minWidth": 100},
-                {"field": "InitialViralLoadDone", "headerName": "Initial Viral Load Done", "flex": 1, "minWidth": 100},
-                {"field": "InitialViralLoadNotDone", "headerName": "Initial Viral Load Not Done", "flex": 1, "minWidth": 100},
-                {"field": "InitialViralLoadSuppressed", "headerName": "Initial Viral Load Suppressed", "flex": 1, "minWidth": 100},
-                {"field": "InitialViralLoadUnsuppressed", "headerName": "Initial Viral Load Unsuppressed", "flex": 1, "minWidth": 100},
-                {"field": "RegimenChangeDone", "headerName": "Regimen Change Done", "flex": 1, "minWidth": 100},
-                {"field": "RegimenChangeNotDone", "headerName": "Regimen Change Not Done", "flex": 1, "minWidth": 100},
-                {"field": "LatestVLSuppressed", "headerName": "Latest VL Suppressed", "flex": 1, "minWidth": 100},
-                {"field": "LatestVLUnsuppressed", "headerName": "Latest VL Unsuppressed", "flex": 1, "minWidth": 100},
-                {"field": "PatientsRetained", "headerName": "Patients Retained", "flex": 1, "minWidth": 100},
-                {"field": "PatientsNotRetained", "headerName": "Patients Not Retained", "flex": 1, "minWidth": 100},
-            ],
-            "rows": [{
-                "gender": row.Gender,
-                "initialCD4NotDone": row.InitialCD4NotDone,
-                "InitialViralLoadDone": row.InitialViralLoadDone,
-                "InitialViralLoadNotDone": row.InitialViralLoadNotDone,
-                "InitialViralLoadSuppressed": row.InitialViralLoadSuppressed,
-                "InitialViralLoadUnsuppressed": row.InitialViralLoadUnsuppressed,
-                "RegimenChangeDone": row.RegimenChangeDone,
-                "RegimenChangeNotDone": row.RegimenChangeNotDone,
-                "LatestVLSuppressed": row.LatestVLSuppressed,
-                "LatestVLUnsuppressed": row.LatestVLUnsuppressed,
-                "PatientsRetained": row.PatientsRetained,
-                "PatientsNotRetained": row.PatientsNotRetained,
-            } for row in data2]
-        })
-
-    elif node.node in ['Initial CD4 Done']:
-        query2 = f"""
-        SELECT 
-            Gender,
-            SUM(WithBaselineCD4) AS InitialCD4Done,
-            SUM(AHD) AS WithAHD,
-            SUM(CASE WHEN AHD = 0 THEN 1 ELSE 0 END) AS  WithoutAHD,
-            SUM(NotStaged) AS NotStaged,
-            SUM(WithInitialViralLoad) AS InitialViralLoadDone,
-            SUM(WithoutInitialViralLoad) AS InitialViralLoadNotDone,
-            SUM(IsSuppressedInitialViralload) AS InitialViralLoadSuppressed,
-            SUM(IIF(CsSentinelEvents.IsSuppressedInitialViralload = 0, 1, 0)) AS InitialViralLoadUnsuppressed,
-            SUM(RegimenChanged) AS RegimenChangeDone,
-            SUM(RegimenNotChanged) AS RegimenChangeNotDone,
-            SUM(LatestVLSuppressed) AS LatestVLSuppressed,
-            SUM(LatestVLNotSuppressed) AS LatestVLUnsuppressed,
-            SUM(PatientRetained) AS PatientsRetained,
-            SUM(PatientNotRetained) AS PatientsNotRetained
-        FROM CsSentinelEvents
-        WHERE LinkedToART = 1 and WithoutBaselineCD4 = 1 and CohortYearMonth >= '{node.CohortYearMonthStart}' and CohortYearMonth <= '{node.CohortYearMonthEnd}' {filter_string}
-        GROUP BY Gender
-        """
-        data2 = db.execute(text(query2)).fetchall()
-
-        result.append({
-            "tableTitle": f"Sex Distribution For Followup Events",
-            "columns": [
-                {"field": "gender", "headerName": "Sex", "flex": 1, "minWidth": 100},
-                {"field": "initialCD4Done", "headerName": "Initial CD4 Done", "flex": 1, "minWidth": 100},
-                {"field": "withAHD", "headerName": "With AHD", "flex": 1, "minWidth": 100},
-                {"field": "WithoutAHD", "headerName": "Without AHD", "flex": 1, "minWidth": 100},
-                {"field": "NotStaged", "headerName": "Not Staged", "flex": 1, "minWidth": 100},
-                {"field": "InitialViralLoadDone", "headerName": "Initial Viral Load Done", "flex": 1, "minWidth": 100},
-                {"field": "InitialViralLoadNotDone", "headerName": "Initial Viral Load Not Done", "flex": 1, "minWidth": 100},
-                {"field": "InitialViralLoadSuppressed", "headerName": "Initial Viral Load Suppressed", "flex": 1, "minWidth": 100},
-                {"field": "InitialViralLoadUnsuppressed", "headerName": "Initial Viral Load Unsuppressed", "flex": 1, "minWidth": 100},
-                {"field": "RegimenChangeDone", "headerName": "Regimen Change Done", "flex": 1, "minWidth": 100},
-                {"field": "RegimenChangeNotDone", "headerName": "Regimen Change Not Done", "flex": 1, "minWidth": 100},
-                {"field": "LatestVLSuppressed", "headerName": "Latest VL Suppressed", "flex": 1, "minWidth": 100},
-                {"field": "LatestVLUnsuppressed", "headerName": "Latest VL Unsuppressed", "flex": 1, "minWidth": 100},
-                {"field": "PatientsRetained", "headerName": "Patients Retained", "flex": 1, "minWidth": 100},
-                {"field": "PatientsNotRetained", "headerName": "Patients Not Retained", "flex": 1, "minWidth": 100},
-            ],
-            "rows": [{
-                "gender": row.Gender,
-                "initialCD4Done": row.InitialCD4Done,
-                "withAHD": row.WithAHD,
-                "WithoutAHD": row.WithoutAHD,
-                "NotStaged": row.NotStaged,
-                "InitialViralLoadDone": row.InitialViralLoadDone,
-                "InitialViralLoadNotDone": row.InitialViralLoadNotDone,
-                "InitialViralLoadSuppressed": row.InitialViralLoadSuppressed,
-                "InitialViralLoadUnsuppressed": row.InitialViralLoadUnsuppressed,
-                "RegimenChangeDone": row.RegimenChangeDone,
-                "RegimenChangeNotDone": row.RegimenChangeNotDone,
-                "LatestVLSuppressed": row.LatestVLSuppressed,
-                "LatestVLUnsuppressed": row.LatestVLUnsuppressed,
-                "PatientsRetained": row.PatientsRetained,
-                "PatientsNotRetained": row.PatientsNotRetained,
-            } for row in data2]
-        })
-
-    elif node.node in ['Not Linked']:
-        query1 = f"""
-        SELECT Gender, SUM(NotLinkedToART) as number 
-        FROM CsSentinelEvents 
-        WHERE CohortYearMonth >= '{node.CohortYearMonthStart}' and CohortYearMonth <= '{node.CohortYearMonthEnd}' {filter_string}
-        GROUP BY Gender;
-        """
-        data1 = db.execute(text(query1)).fetchall()
-
-        result.append({
-            "tableTitle": f"Sex Distribution Among New Cases Reported",
-            "columns": [
-                {"field": "gender", "headerName": "Sex", "flex": 1, "minWidth": 100},
-                {"field": "number", "headerName": "Number", "flex": 1, "minWidth": 100}
-            ],
-            "rows": [{"gender": row.Gender, "number": row.number} for row in data1]
-        })
-
-    elif node.node in ['With AHD']:
-        query2 = f"""
-                SELECT 
-                    Gender,
-                    SUM(AHD) AS WithAHD,
-                    SUM(WithInitialViralLoad) AS InitialViralLoadDone,
-                    SUM(WithoutInitialViralLoad) AS InitialViralLoadNotDone,
-                    SUM(IsSuppressedInitialViralload) AS InitialViralLoadSuppressed,
-                    SUM(IIF(CsSentinelEvents.IsSuppressedInitialViralload = 0, 1, 0)) AS InitialViralLoadUnsuppressed,
-                    SUM(RegimenChanged) AS RegimenChangeDone,
-                    SUM(RegimenNotChanged) AS RegimenChangeNotDone,
-                    SUM(LatestVLSuppressed) AS LatestVLSuppressed,
-                    SUM(LatestVLNotSuppressed) AS LatestVLUnsuppressed,
-                    SUM(PatientRetained) AS PatientsRetained,
-                    SUM(PatientNotRetained) AS PatientsNotRetained
-                FROM CsSentinelEvents
-                WHERE LinkedToART = 1 and WithBaselineCD4 = 1 and AHD = 1 and CohortYearMonth >= '{node.CohortYearMonthStart}' and CohortYearMonth <= '{node.CohortYearMonthEnd}' {filter_string}
-                GROUP BY Gender
-                """
-        data2 = db.execute(text(query2)).fetchall()
-
-        result.append({
-            "tableTitle": f"Sex Distribution For Followup Events",
-            "columns": [
-                {"field": "gender", "headerName": "Sex", "flex": 1, "minWidth": 100},
-                {"field": "withAHD", "headerName": "With AHD", "flex": 1, "minWidth": 100},
-                {"field": "InitialViralLoadDone", "headerName": "Initial Viral Load Done", "flex": 1, "minWidth": 100},
-                {"field": "InitialViralLoadNotDone", "headerName": "Initial Viral Load Not Done", "flex": 1,
-                 "minWidth": 100},
-                {"field": "InitialViralLoadSuppressed", "headerName": "Initial Viral Load Suppressed", "flex": 1,
-                 "minWidth": 100},
-                {"field": "InitialViralLoadUnsuppressed", "headerName": "Initial Viral Load Unsuppressed", "flex": 1,
-                 "minWidth": 100},
-                {"field": "RegimenChangeDone", "headerName": "Regimen Change Done", "flex": 1, "minWidth": 100},
-                {"field": "RegimenChangeNotDone", "headerName": "Regimen Change Not Done", "flex": 1, "minWidth": 100},
-                {"field": "LatestVLSuppressed", "headerName": "Latest VL Suppressed", "flex": 1, "minWidth": 100},
-                {"field": "LatestVLUnsuppressed", "headerName": "Latest VL Unsuppressed", "flex": 1, "minWidth": 100},
-                {"field": "PatientsRetained", "headerName": "Patients Retained", "flex": 1, "minWidth": 100},
-                {"field": "PatientsNotRetained", "headerName": "Patients Not Retained", "flex": 1, "minWidth": 100},
-            ],
-            "rows": [{
-                "gender": row.Gender,
-                "withAHD": row.WithAHD,
-                "InitialViralLoadDone": row.InitialViralLoadDone,
-                "InitialViralLoadNotDone": row.InitialViralLoadNotDone,
-                "InitialViralLoadSuppressed": row.InitialViralLoadSuppressed,
-                "InitialViralLoadUnsuppressed": row.InitialViralLoadUnsuppressed,
-                "RegimenChangeDone": row.RegimenChangeDone,
-                "RegimenChangeNotDone": row.RegimenChangeNotDone,
-                "LatestVLSuppressed": row.LatestVLSuppressed,
-                "LatestVLUnsuppressed": row.LatestVLUnsuppressed,
-                "PatientsRetained": row.PatientsRetained,
-                "PatientsNotRetained": row.PatientsNotRetained,
-            } for row in data2]
-        })
-
-    elif node.node in ['Without AHD']:
-        query2 = f"""
-                SELECT 
-                    Gender,
-                    SUM(CASE WHEN AHD = 0 THEN 1 ELSE 0 END) AS WithoutAHD,
-                    SUM(WithInitialViralLoad) AS InitialViralLoadDone,
-                    SUM(WithoutInitialViralLoad) AS InitialViralLoadNotDone,
-                    SUM(IsSuppressedInitialViralload) AS InitialViralLoadSuppressed,
-                    SUM(IIF(CsSentinelEvents.IsSuppressedInitialViralload = 0, 1, 0)) AS InitialViralLoadUnsuppressed,
-                    SUM(RegimenChanged) AS RegimenChangeDone,
-                    SUM(RegimenNotChanged) AS RegimenChangeNotDone,
-                    SUM(LatestVLSuppressed) AS LatestVLSuppressed,
-                    SUM(LatestVLNotSuppressed) AS LatestVLUnsuppressed,
-                    SUM(PatientRetained) AS PatientsRetained,
-                    SUM(PatientNotRetained) AS PatientsNotRetained
-                FROM CsSentinelEvents
-                WHERE LinkedToART = 1 and WithBaselineCD4 = 1 and AHD = 0 and CohortYearMonth >= '{node.CohortYearMonthStart}' and CohortYearMonth <= '{node.CohortYearMonthEnd}' {filter_string}
-                GROUP BY Gender
-                """
-        data2 = db.execute(text(query2)).fetchall()
-
-        result.append({
-            "tableTitle": f"Sex Distribution For Followup Events",
-            "columns": [
-                {"field": "gender", "headerName": "Sex", "flex": 1, "minWidth": 100},
-                {"field": "WithoutAHD", "headerName": "Without AHD", "flex": 1, "minWidth": 100},
-                {"field": "InitialViralLoadDone", "headerName": "Initial Viral Load Done", "flex": 1, "minWidth": 100},
-                {"field": "InitialViralLoadNotDone", "headerName": "Initial Viral Load Not Done", "flex": 1,
-                 "minWidth": 100},
-                {"field": "InitialViralLoadSuppressed", "headerName": "Initial Viral Load Suppressed", "flex": 1,
-                 "minWidth": 100},
-                {"field": "InitialViralLoadUnsuppressed", "headerName": "Initial Viral Load Unsuppressed", "flex": 1,
-                 "minWidth": 100},
-                {"field": "RegimenChangeDone", "headerName": "Regimen Change Done", "flex": 1, "minWidth": 100},
-                {"field": "RegimenChangeNotDone", "headerName": "Regimen Change Not Done", "flex": 1, "minWidth": 100},
-                {"field": "LatestVLSuppressed", "headerName": "Latest VL Suppressed", "flex": 1, "minWidth": 100},
-                {"field": "LatestVLUnsuppressed", "headerName": "Latest VL Unsuppressed", "flex": 1, "minWidth": 100},
-                {"field": "PatientsRetained", "headerName": "Patients Retained", "flex": 1, "minWidth": 100},
-                {"field": "PatientsNotRetained", "headerName": "Patients Not Retained", "flex": 1, "minWidth": 100},
-            ],
-            "rows": [{
-                "gender": row.Gender,
-                "WithoutAHD": row.WithoutAHD,
-                "InitialViralLoadDone": row.InitialViralLoadDone,
-                "InitialViralLoadNotDone": row.InitialViralLoadNotDone,
-                "InitialViralLoadSuppressed": row.InitialViralLoadSuppressed,
-                "InitialViralLoadUnsuppressed": row.InitialViralLoadUnsuppressed,
-                "RegimenChangeDone": row.RegimenChangeDone,
-                "RegimenChangeNotDone": row.RegimenChangeNotDone,
-                "LatestVLSuppressed": row.LatestVLSuppressed,
-                "LatestVLUnsuppressed": row.LatestVLUnsuppressed,
-                "PatientsRetained": row.PatientsRetained,
-                "PatientsNotRetained": row.PatientsNotRetained,
-            } for row in data2]
-        })
-
-    elif node.node in ['Not Staged']:
-        query2 = f"""
-                SELECT 
-                    Gender,
-                    SUM(NotStaged) AS NotStaged,
-                    SUM(WithInitialViralLoad) AS InitialViralLoadDone,
-                    SUM(WithoutInitialViralLoad) AS InitialViralLoadNotDone,
-                    SUM(IsSuppressedInitialViralload) AS InitialViralLoadSuppressed,
-                    SUM(IIF(CsSentinelEvents.IsSuppressedInitialViralload = 0, 1, 0)) AS InitialViralLoadUnsuppressed,
-                    SUM(RegimenChanged) AS RegimenChangeDone,
-                    SUM(RegimenNotChanged) AS RegimenChangeNotDone,
-                    SUM(LatestVLSuppressed) AS LatestVLSuppressed,
-                    SUM(LatestVLNotSuppressed) AS LatestVLUnsuppressed,
-                    SUM(PatientRetained) AS PatientsRetained,
-                    SUM(PatientNotRetained) AS PatientsNotRetained
-                FROM CsSentinelEvents
-                WHERE LinkedToART = 1 and WithBaselineCD4 = 1 and NotStaged = 1 and CohortYearMonth >= '{node.CohortYearMonthStart}' and CohortYearMonth <= '{node.CohortYearMonthEnd}' {filter_string}
-                GROUP BY Gender
-                """
-        data2 = db.execute(text(query2)).fetchall()
-
-        result.append({
-            "tableTitle": f"Sex Distribution For Followup Events",
-            "columns": [
-                {"field": "gender", "headerName": "Sex", "flex": 1, "minWidth": 100},
-                {"field": "NotStaged", "headerName": "Not Staged", "flex": 1, "minWidth": 100},
-                {"field": "InitialViralLoadDone", "headerName": "Initial Viral Load Done", "flex": 1, "minWidth": 100},
-                {"field": "InitialViralLoadNotDone", "headerName": "Initial Viral Load Not Done", "flex": 1,
-                 "minWidth": 100},
-                {"field": "InitialViralLoadSuppressed", "headerName": "Initial Viral Load Suppressed", "flex": 1,
-                 "minWidth": 100},
-                {"field": "InitialViralLoadUnsuppressed", "headerName": "Initial Viral Load Unsuppressed", "flex": 1,
-                 "minWidth": 100},
-                {"field": "RegimenChangeDone", "headerName": "Regimen Change Done", "flex": 1, "minWidth": 100},
-                {"field": "RegimenChangeNotDone", "headerName": "Regimen Change Not Done", "flex": 1, "minWidth": 100},
-                {"field": "LatestVLSuppressed", "headerName": "Latest VL Suppressed", "flex": 1, "minWidth": 100},
-                {"field": "LatestVLUnsuppressed", "headerName": "Latest VL Unsuppressed", "flex": 1, "minWidth": 100},
-                {"field": "PatientsRetained", "headerName": "Patients Retained", "flex": 1, "minWidth": 100},
-                {"field": "PatientsNotRetained", "headerName": "Patients Not Retained", "flex": 1, "minWidth": 100},
-            ],
-            "rows": [{
-                "gender": row.Gender,
-                "NotStaged": row.NotStaged,
-                "InitialViralLoadDone": row.InitialViralLoadDone,
-                "InitialViralLoadNotDone": row.InitialViralLoadNotDone,
-                "InitialViralLoadSuppressed": row.InitialViralLoadSuppressed,
-                "InitialViralLoadUnsuppressed": row.InitialViralLoadUnsuppressed,
-                "RegimenChangeDone": row.RegimenChangeDone,
-                "RegimenChangeNotDone": row.RegimenChangeNotDone,
-                "LatestVLSuppressed": row.LatestVLSuppressed,
-                "LatestVLUnsuppressed": row.LatestVLUnsuppressed,
-                "PatientsRetained": row.PatientsRetained,
-                "PatientsNotRetained": row.PatientsNotRetained,
-            } for row in data2]
-        })
-
-    elif node.node in ['Initial Viral Load Done']:
-        query2 = f"""
-                SELECT 
-                    Gender,
-                    SUM(WithInitialViralLoad) AS InitialViralLoadDone,
-                    SUM(IsSuppressedInitialViralload) AS InitialViralLoadSuppressed,
-                    SUM(IIF(CsSentinelEvents.IsSuppressedInitialViralload = 0, 1, 0)) AS InitialViralLoadUnsuppressed,
-                    SUM(RegimenChanged) AS RegimenChangeDone,
-                    SUM(RegimenNotChanged) AS RegimenChangeNotDone,
-                    SUM(LatestVLSuppressed) AS LatestVLSuppressed,
-                    SUM(LatestVLNotSuppressed) AS LatestVLUnsuppressed,
-                    SUM(PatientRetained) AS PatientsRetained,
-                    SUM(PatientNotRetained) AS PatientsNotRetained
-                FROM CsSentinelEvents
-                WHERE LinkedToART = 1 and WithInitialViralLoad = 1 and CohortYearMonth >= '{node.CohortYearMonthStart}' and CohortYearMonth <= '{node.CohortYearMonthEnd}' {filter_string}
-                GROUP BY Gender
-                """
-        data2 = db.execute(text(query2)).fetchall()
-
-        result.append({
-            "tableTitle": f"Sex Distribution For Followup Events",
-            "columns": [
-                {"field": "gender", "headerName": "Sex", "flex": 1, "minWidth": 100},
-                {"field": "InitialViralLoadDone", "headerName": "Initial Viral Load Done", "flex": 1, "minWidth": 100},
-                {"field": "InitialViralLoadSuppressed", "headerName": "Initial Viral Load Suppressed", "flex": 1,
-                 "minWidth": 100},
-                {"field": "InitialViralLoadUnsuppressed", "headerName": "Initial Viral Load Unsuppressed", "flex": 1,
-                 "minWidth": 100},
-                {"field": "RegimenChangeDone", "headerName": "Regimen Change Done", "flex": 1, "minWidth": 100},
-                {"field": "RegimenChangeNotDone", "headerName": "Regimen Change Not Done", "flex": 1, "minWidth": 100},
-                {"field": "LatestVLSuppressed", "headerName": "Latest VL Suppressed", "flex": 1, "minWidth": 100},
-                {"field": "LatestVLUnsuppressed", "headerName": "Latest VL Unsuppressed", "flex": 1, "minWidth": 100},
-                {"field": "PatientsRetained", "headerName": "Patients Retained", "flex": 1, "minWidth": 100},
-                {"field": "PatientsNotRetained", "headerName": "Patients Not Retained", "flex": 1, "minWidth": 100},
-            ],
-            "rows": [{
-                "gender": row.Gender,
-                "InitialViralLoadDone": row.InitialViralLoadDone,
-                "InitialViralLoadSuppressed": row.InitialViralLoadSuppressed,
-                "InitialViralLoadUnsuppressed": row.InitialViralLoadUnsuppressed,
-                "RegimenChangeDone": row.RegimenChangeDone,
-                "RegimenChangeNotDone": row.RegimenChangeNotDone,
-                "LatestVLSuppressed": row.LatestVLSuppressed,
-                "LatestVLUnsuppressed": row.LatestVLUnsuppressed,
-                "PatientsRetained": row.PatientsRetained,
-                "PatientsNotRetained": row.PatientsNotRetained,
-            } for row in data2]
-        })
-
-    elif node.node in ['Initial Viral Load Not Done']:
-        query2 = f"""
-                SELECT 
-                    Gender,
-                    SUM(WithoutInitialViralLoad) AS InitialViralLoadNotDone,
-                    SUM(RegimenChanged) AS RegimenChangeDone,
-                    SUM(RegimenNotChanged) AS RegimenChangeNotDone,
-                    SUM(LatestVLSuppressed) AS LatestVLSuppressed,
-                    SUM(LatestVLNotSuppressed) AS LatestVLUnsuppressed,
-                    SUM(PatientRetained) AS PatientsRetained,
-                    SUM(PatientNotRetained) AS PatientsNotRetained
-                FROM CsSentinelEvents
-                WHERE LinkedToART = 1 and WithoutInitialViralLoad = 1 and CohortYearMonth >= '{node.CohortYearMonthStart}' and CohortYearMonth <= '{node.CohortYearMonthEnd}' {filter_string}
-                GROUP BY Gender
-                """
-        data2 = db.execute(text(query2)).fetchall()
-
-        result.append({
-            "tableTitle": f"Sex Distribution For Followup Events",
-            "columns": [
-                {"field": "gender", "headerName": "Sex", "flex": 1, "minWidth": 100},
-                {"field": "InitialViralLoadNotDone", "headerName": "Initial Viral Load Not Done", "flex": 1, "minWidth": 100},
-                {"field": "RegimenChangeDone", "headerName": "Regimen Change Done", "flex": 1, "minWidth": 100},
-                {"field": "RegimenChangeNotDone", "headerName": "Regimen Change Not Done", "flex": 1, "minWidth": 100},
-                {"field": "LatestVLSuppressed", "headerName": "Latest VL Suppressed", "flex": 1, "minWidth": 100},
-                {"field": "LatestVLUnsuppressed", "headerName": "Latest VL Unsuppressed", "flex": 1, "minWidth": 100},
-                {"field": "PatientsRetained", "headerName": "Patients Retained", "flex": 1, "minWidth": 100},
-                {"field": "PatientsNotRetained", "headerName": "Patients Not Retained", "flex": 1, "minWidth": 100},
-            ],
-            "rows": [{
-                "gender": row.Gender,
-                "InitialViralLoadNotDone": row.InitialViralLoadNotDone,
-                "RegimenChangeDone": row.RegimenChangeDone,
-                "RegimenChangeNotDone": row.RegimenChangeNotDone,
-                "LatestVLSuppressed": row.LatestVLSuppressed,
-                "LatestVLUnsuppressed": row.LatestVLUnsuppressed,
-                "PatientsRetained": row.PatientsRetained,
-                "PatientsNotRetained": row.PatientsNotRetained,
-            } for row in data2]
-        })
-
-    elif node.node in ['Initial Viral Load Suppressed']:
-        query2 = f"""
-                SELECT 
-                    Gender,
-                    SUM(IsSuppressedInitialViralload) AS InitialViralLoadSuppressed,
-                    SUM(RegimenChanged) AS RegimenChangeDone,
-                    SUM(RegimenNotChanged) AS RegimenChangeNotDone,
-                    SUM(LatestVLSuppressed) AS LatestVLSuppressed,
-                    SUM(LatestVLNotSuppressed) AS LatestVLUnsuppressed,
-                    SUM(PatientRetained) AS PatientsRetained,
-                    SUM(PatientNotRetained) AS PatientsNotRetained
-                FROM CsSentinelEvents
-                WHERE LinkedToART = 1 and IsSuppressedInitialViralload = 1 and WithoutInitialViralLoad = 0 and CohortYearMonth >= '{node.CohortYearMonthStart}' and CohortYearMonth <= '{node.CohortYearMonthEnd}' {filter_string}
-                GROUP BY Gender
-                """
-        data2 = db.execute(text(query2)).fetchall()
-
-        result.append({
-            "tableTitle": f"Sex Distribution For Followup Events",
-            "columns": [
-                {"field": "gender", "headerName": "Sex", "flex": 1, "minWidth": 100},
-                {"field": "InitialViralLoadSuppressed", "headerName": "Initial Viral Load Suppressed", "flex": 1, "minWidth": 100},
-                {"field": "RegimenChangeDone", "headerName": "Regimen Change Done", "flex": 1, "minWidth": 100},
-                {"field": "RegimenChangeNotDone", "headerName": "Regimen Change Not Done", "flex": 1, "minWidth": 100},
-                {"field": "LatestVLSuppressed", "headerName": "Latest VL Suppressed", "flex": 1, "minWidth": 100},
-                {"field": "LatestVLUnsuppressed", "headerName": "Latest VL Unsuppressed", "flex": 1, "minWidth": 100},
-                {"field": "PatientsRetained", "headerName": "Patients Retained", "flex": 1, "minWidth": 100},
-                {"field": "PatientsNotRetained", "headerName": "Patients Not Retained", "flex": 1, "minWidth": 100},
-            ],
-            "rows": [{
-                "gender": row.Gender,
-                "InitialViralLoadSuppressed": row.InitialViralLoadSuppressed,
-                "RegimenChangeDone": row.RegimenChangeDone,
-                "RegimenChangeNotDone": row.RegimenChangeNotDone,
-                "LatestVLSuppressed": row.LatestVLSuppressed,
-                "LatestVLUnsuppressed": row.LatestVLUnsuppressed,
-                "PatientsRetained": row.PatientsRetained,
-                "PatientsNotRetained": row.PatientsNotRetained,
-            } for row in data2]
-        })
-
-    elif node.node in ['Initial Viral Load Unsuppressed']:
-        query2 = f"""
-                SELECT 
-                    Gender,
-                    SUM(IIF(CsSentinelEvents.IsSuppressedInitialViralload = 0, 1, 0)) AS InitialViralLoadUnsuppressed,
-                    SUM(RegimenChanged) AS RegimenChangeDone,
-                    SUM(RegimenNotChanged) AS RegimenChangeNotDone,
-                    SUM(LatestVLSuppressed) AS LatestVLSuppressed,
-                    SUM(LatestVLNotSuppressed) AS LatestVLUnsuppressed,
-                    SUM(PatientRetained) AS PatientsRetained,
-                    SUM(PatientNotRetained) AS PatientsNotRetained
-                FROM CsSentinelEvents
-                WHERE LinkedToART = 1 and IsSuppressedInitialViralload = 0 and WithoutInitialViralLoad = 0 and CohortYearMonth >= '{node.CohortYearMonthStart}' and CohortYearMonth <= '{node.CohortYearMonthEnd}' {filter_string}
-                GROUP BY Gender
-                """
-        data2 = db.execute(text(query2)).fetchall()
-
-        result.append({
-            "tableTitle": f"Sex Distribution For Followup Events",
-            "columns": [
-                {"field": "gender", "headerName": "Sex", "flex": 1, "minWidth": 100},
-                {"field": "InitialViralLoadUnsuppressed", "headerName": "Initial Viral Load Unsuppressed", "flex": 1, "minWidth": 100},
-                {"field": "RegimenChangeDone", "headerName": "Regimen Change Done", "flex": 1, "minWidth": 100},
-                {"field": "RegimenChangeNotDone", "headerName": "Regimen Change Not Done", "flex": 1, "minWidth": 100},
-                {"field": "LatestVLSuppressed", "headerName": "Latest VL Suppressed", "flex": 1, "minWidth": 100},
-                {"field": "LatestVLUnsuppressed", "headerName": "Latest VL Unsuppressed", "flex": 1, "minWidth": 100},
-                {"field": "PatientsRetained", "headerName": "Patients Retained", "flex": 1, "minWidth": 100},
-                {"field": "PatientsNotRetained", "headerName": "Patients Not Retained", "flex": 1, "minWidth": 100},
-            ],
-            "rows": [{
-                "gender": row.Gender,
-                "InitialViralLoadUnsuppressed": row.InitialViralLoadUnsuppressed,
-                "RegimenChangeDone": row.RegimenChangeDone,
-                "RegimenChangeNotDone": row.RegimenChangeNotDone,
-                "LatestVLSuppressed": row.LatestVLSuppressed,
-                "LatestVLUnsuppressed": row.LatestVLUnsuppressed,
-                "PatientsRetained": row.PatientsRetained,
-                "PatientsNotRetained": row.PatientsNotRetained,
-            } for row in data2]
-        })
-
-    elif node.node in ['Regimen Change Not Done']:
-        query2 = f"""
-                SELECT 
-                    Gender,
-                    SUM(RegimenNotChanged) AS RegimenChangeNotDone,
-                    SUM(LatestVLSuppressed) AS LatestVLSuppressed,
-                    SUM(LatestVLNotSuppressed) AS LatestVLUnsuppressed,
-                    SUM(PatientRetained) AS PatientsRetained,
-                    SUM(PatientNotRetained) AS PatientsNotRetained
-                FROM CsSentinelEvents
-                WHERE LinkedToART = 1 and RegimenChangeNotDone = 1 and CohortYearMonth >= '{node.CohortYearMonthStart}' and CohortYearMonth <= '{node.CohortYearMonthEnd}' {filter_string}
-                GROUP BY Gender
-                """
-        data2 = db.execute(text(query2)).fetchall()
-
-        result.append({
-            "tableTitle": f"Sex Distribution For Followup Events",
-            "columns": [
-                {"field": "gender", "headerName": "Sex", "flex": 1, "minWidth": 100},
-                {"field": "InitialViralLoadUnsuppressed", "headerName": "Initial Viral Load Unsuppressed", "flex": 1, "minWidth": 100},
-                {"field": "RegimenChangeNotDone", "headerName": "Regimen Change Not Done", "flex": 1, "minWidth": 100},
-                {"field": "LatestVLSuppressed", "headerName": "Latest VL Suppressed", "flex": 1, "minWidth": 100},
-                {"field": "LatestVLUnsuppressed", "headerName": "Latest VL Unsuppressed", "flex": 1, "minWidth": 100},
-                {"field": "PatientsRetained", "headerName": "Patients Retained", "flex": 1, "minWidth": 100},
-                {"field": "PatientsNotRetained", "headerName": "Patients Not Retained", "flex": 1, "minWidth": 100},
-            ],
-            "rows": [{
-                "gender": row.Gender,
-                "InitialViralLoadUnsuppressed": row.InitialViralLoadUnsuppressed,
-                "RegimenChangeNotDone": row.RegimenChangeNotDone,
-                "LatestVLSuppressed": row.LatestVLSuppressed,
-                "LatestVLUnsuppressed": row.LatestVLUnsuppressed,
-                "PatientsRetained": row.PatientsRetained,
-                "PatientsNotRetained": row.PatientsNotRetained,
-            } for row in data2]
-        })
-
-    elif node.node in ['Regimen Change Done']:
-        query2 = f"""
-                SELECT 
-                    Gender,
-                    SUM(RegimenChanged) AS RegimenChangeDone,
-                    SUM(LatestVLSuppressed) AS LatestVLSuppressed,
-                    SUM(LatestVLNotSuppressed) AS LatestVLUnsuppressed,
-                    SUM(PatientRetained) AS PatientsRetained,
-                    SUM(PatientNotRetained) AS PatientsNotRetained
-                FROM CsSentinelEvents
-                WHERE LinkedToART = 1 and RegimenChanged = 1 and CohortYearMonth >= '{node.CohortYearMonthStart}' and CohortYearMonth <= '{node.CohortYearMonthEnd}' {filter_string}
-                GROUP BY Gender
-                """
-        data2 = db.execute(text(query2)).fetchall()
-
-        result.append({
-            "tableTitle": f"Sex Distribution For Followup Events",
-            "columns": [
-                {"field": "gender", "headerName": "Sex", "flex": 1, "minWidth": 100},
-                {"field": "RegimenChangeDone", "headerName": "Regimen Change Done", "flex": 1, "minWidth": 100},
-                {"field": "LatestVLSuppressed", "headerName": "Latest VL Suppressed", "flex": 1, "minWidth": 100},
-                {"field": "LatestVLUnsuppressed", "headerName": "Latest VL Unsuppressed", "flex": 1, "minWidth": 100},
-                {"field": "PatientsRetained", "headerName": "Patients Retained", "flex": 1, "minWidth": 100},
-                {"field": "PatientsNotRetained", "headerName": "Patients Not Retained", "flex": 1, "minWidth": 100},
-            ],
-            "rows": [{
-                "gender": row.Gender,
-                "RegimenChangeDone": row.RegimenChangeDone,
-                "LatestVLSuppressed": row.LatestVLSuppressed,
-                "LatestVLUnsuppressed": row.LatestVLUnsuppressed,
-                "PatientsRetained": row.PatientsRetained,
-                "PatientsNotRetained": row.PatientsNotRetained,
-            } for row in data2]
-        })
-
-    elif node.node in ['Latest Viral Load Unsuppressed']:
-        query2 = f"""
-                SELECT 
-                    Gender,
-                    SUM(LatestVLNotSuppressed) AS LatestVLUnsuppressed,
-                    SUM(PatientRetained) AS PatientsRetained,
-                    SUM(PatientNotRetained) AS PatientsNotRetained
-                FROM CsSentinelEvents
-                WHERE LinkedToART = 1 and LatestVLNotSuppressed = 1 and CohortYearMonth >= '{node.CohortYearMonthStart}' and CohortYearMonth <= '{node.CohortYearMonthEnd}' {filter_string}
-                GROUP BY Gender
-                """
-        data2 = db.execute(text(query2)).fetchall()
-
-        result.append({
-            "tableTitle": f"Sex Distribution For Followup Events",
-            "columns": [
-                {"field": "gender", "headerName": "Sex", "flex": 1, "minWidth": 100},
-                {"field": "LatestVLUnsuppressed", "headerName": "Latest VL Unsuppressed", "flex": 1, "minWidth": 100},
-                {"field": "PatientsRetained", "headerName": "Patients Retained", "flex": 1, "minWidth": 100},
-                {"field": "PatientsNotRetained", "headerName": "Patients Not Retained", "flex": 1, "minWidth": 100},
-            ],
-            "rows": [{
-                "gender": row.Gender,
-                "LatestVLUnsuppressed": row.LatestVLUnsuppressed,
-                "PatientsRetained": row.PatientsRetained,
-                "PatientsNotRetained": row.PatientsNotRetained,
-            } for row in data2]
-        })
-
-    elif node.node in ['Latest Viral Load Suppressed']:
-        query2 = f"""
-                SELECT 
-                    Gender,
-                    SUM(LatestVLSuppressed) AS LatestVLSuppressed,
-                    SUM(PatientRetained) AS PatientsRetained,
-                    SUM(PatientNotRetained) AS PatientsNotRetained
-                FROM CsSentinelEvents
-                WHERE LinkedToART = 1 and LatestVLSuppressed = 1 and CohortYearMonth >= '{node.CohortYearMonthStart}' and CohortYearMonth <= '{node.CohortYearMonthEnd}' {filter_string}
-                GROUP BY Gender
-                """
-        data2 = db.execute(text(query2)).fetchall()
-
-        result.append({
-            "tableTitle": f"Sex Distribution For Followup Events",
-            "columns": [
-                {"field": "gender", "headerName": "Sex", "flex": 1, "minWidth": 100},
-                {"field": "LatestVLSuppressed", "headerName": "Latest VL Suppressed", "flex": 1, "minWidth": 100},
-                {"field": "PatientsRetained", "headerName": "Patients Retained", "flex": 1, "minWidth": 100},
-                {"field": "PatientsNotRetained", "headerName": "Patients Not Retained", "flex": 1, "minWidth": 100},
-            ],
-            "rows": [{
-                "gender": row.Gender,
-                "LatestVLSuppressed": row.LatestVLSuppressed,
-                "PatientsRetained": row.PatientsRetained,
-                "PatientsNotRetained": row.PatientsNotRetained,
-            } for row in data2]
-        })
-
-    elif node.node in ['Patients Not Retained']:
-        query2 = f"""
-                SELECT 
-                    Gender,
-                    SUM(PatientNotRetained) AS PatientsNotRetained
-                FROM CsSentinelEvents
-                WHERE LinkedToART = 1 and PatientsNotRetained = 1 and CohortYearMonth >= '{node.CohortYearMonthStart}' and CohortYearMonth <= '{node.CohortYearMonthEnd}' {filter_string}
-                GROUP BY Gender
-                """
-        data2 = db.execute(text(query2)).fetchall()
-
-        result.append({
-            "tableTitle": f"Sex Distribution For Followup Events",
-            "columns": [
-                {"field": "gender", "headerName": "Sex", "flex": 1, "minWidth": 100},
-                {"field": "PatientsNotRetained", "headerName": "Patients Not Retained", "flex": 1, "minWidth": 100},
-            ],
-            "rows": [{
-                "gender": row.Gender,
-                "PatientsNotRetained": row.PatientsNotRetained,
-            } for row in data2]
-        })
-
-    elif node.node in ['Patients Retained']:
-        query2 = f"""
-                SELECT 
-                    Gender,
-                    SUM(PatientRetained) AS PatientsRetained
-                FROM CsSentinelEvents
-                WHERE LinkedToART = 1 and PatientsRetained = 1 and CohortYearMonth >= '{node.CohortYearMonthStart}' and CohortYearMonth <= '{node.CohortYearMonthEnd}' {filter_string}
-                GROUP BY Gender
-                """
-        data2 = db.execute(text(query2)).fetchall()
-
-        result.append({
-            "tableTitle": f"Sex Distribution For Followup Events",
-            "columns": [
-                {"field": "gender", "headerName": "Sex", "flex": 1, "minWidth": 100},
-                {"field": "PatientsRetained", "headerName": "Patients Retained", "flex": 1, "minWidth": 100},
-            ],
-            "rows": [{
-                "gender": row.Gender,
-                "PatientsRetained": row.PatientsRetained,
-            } for row in data2]
-        })
-
-
-    elif 'highcharts' in node.node:
-        return []
+    return sankey_data
+
+
+@app.post("/sankey-data/breakdown", response_model=List[BreakdownTable])
+async def sankey_data_breakdown(request: Request, node: SankeyBreakdown):
+    return await breakdown_response(request, node)
+
+
+@app.get("/sankey-data/breakdown", response_model=List[BreakdownTable])
+async def sankey_data_breakdown_query(request: Request, node: Annotated[SankeyBreakdown, Query()]):
+    return await breakdown_response(request, node)
+
+
+def breakdown_dimensions(node):
+    return tuple(dict.fromkeys(node.dimensions or DEFAULT_DIMENSIONS))
+
+
+def breakdown_tables(plan, name, data, dimensions):
+    # One table per dimension, in the order asked for
+    return [table for dimension in dimensions for table in plan.tables(name, data[dimension], dimension)]
+
+
+async def breakdown_response(request, node):
+    annotate(node=node.node, filter=normalized_filter(node))
+    plan = BreakdownPlan([node.node])
+    if not plan.nodes:
+        return FastJSONResponse([])
+    dimensions = breakdown_dimensions(node)
+    key = filter_key(node, node.node, dimensions)
+    tag, fresh = await validators(request, key)
+    if fresh:
+        return not_modified(tag)
+    content = await breakdown_cache.get(key)
+    if content is None:
+        data = await breakdown_rows(plan, node, dimensions)
+        content = dumps(breakdown_tables(plan, node.node, data, dimensions))
+        await breakdown_cache.set(key, content)
+    return FastJSONResponse(content, headers=cache_headers(tag))
+
+
+@app.post("/sankey-data/breakdown/batch", response_model=Dict[str, List[BreakdownTable]])
+async def sankey_data_breakdown_batch(request: Request, nodes: SankeyBreakdownBatch):
+    names = nodes.nodes if nodes.nodes is not None else list(NODES)
+    annotate(nodes=names, filter=normalized_filter(nodes))
+    dimensions = breakdown_dimensions(nodes)
+    key = filter_key(nodes, tuple(names), dimensions)
+    tag, fresh = await validators(request, key)
+    if fresh:
+        return not_modified(tag)
+    content = await breakdown_cache.get(key)
+    if content is None:
+        plan = BreakdownPlan(names)
+        data = await breakdown_rows(plan, nodes, dimensions) if plan.nodes else {}
+        content = dumps({name: breakdown_tables(plan, name, data, dimensions) if name in plan.nodes else []
+                         for name in names})
+        await breakdown_cache.set(key, content)
+    return FastJSONResponse(content, headers=cache_headers(tag))
+
+
+async def breakdown_rows(plan, node, dimensions=DEFAULT_DIMENSIONS):
+    """{dimension: rows} for every node in ``plan``, from one snapshot pass or one SQL scan."""
+    if BREAKDOWN_ENGINE == "snapshot":
+        try:
+            await asyncio.wait_for(events_snapshot.ensure_loaded(), SANKEY_QUERY_TIMEOUT)
+            return events_snapshot.counts(plan, node, dimensions)
+        except Exception:
+            logger.exception("Events snapshot unavailable, querying the database")
     else:
-        # Table 1: Gender and LinkedToART
-        query1 = f"""
-            SELECT Gender, SUM(LinkedToART) as number 
-            FROM CsSentinelEvents 
-            WHERE CohortYearMonth >= '{node.CohortYearMonthStart}' and CohortYearMonth <= '{node.CohortYearMonthEnd}' {filter_string}
-            GROUP BY Gender;
-        """
-        data1 = db.execute(text(query1)).fetchall()
-
-        result.append({
-            "tableTitle": f"Sex Distribution",
-            "columns": [
-                {"field": "gender", "headerName": "Sex", "flex": 1, "minWidth": 100},
-                {"field": "number", "headerName": "Number", "flex": 1, "minWidth": 100}
-            ],
-            "rows": [{"gender": row.Gender, "number": row.number} for row in data1]
-        })
-
-    return result
-
-
-def format_sql_in_clause(values):
-    if isinstance(values, (list, tuple)) and len(values) == 1:
-        return f"('{values[0]}')"
-    return str(tuple(values))
+        event_rollups.ensure_building()
+        if event_rollups.loaded:
+            counts = event_rollups.counts(plan, node, dimensions)
+            if counts is not None:
+                return counts
+    return await query_flights.do(("breakdown", *filter_key(node, *plan.nodes), dimensions),
+                                  lambda: run_db(query_breakdown, plan, node, dimensions))
+
+
+def query_breakdown(db, plan, node, dimensions=DEFAULT_DIMENSIONS):
+    statement = breakdown_statement(plan, node, dimensions, db.get_bind().dialect.name)
+    return split_rows([row._mapping for row in execute_parameterized(db, statement)], dimensions)
+
+
+# Full-resolution exports stream straight from a server-side cursor and bypass every cache.
+@app.get("/export/sankey")
+def export_sankey(export: Annotated[SankeyExport, Query()]):
+    annotate(export=export.format, filter=normalized_filter(export))
+    by = list(dict.fromkeys(export.by or []))
+    columns = by + ["ord", "source", "target", "weight"]
+    types = [str] * len(by) + [int, str, str, int]
+    return export_response(sankey_export_statement(export, by), columns, types, export.format, "sankey")
+
+
+@app.get("/export/breakdown")
+def export_breakdown(export: Annotated[BreakdownExport, Query()]):
+    annotate(export=export.format, node=export.node, filter=normalized_filter(export))
+    plan = BreakdownPlan([export.node])
+    if not plan.nodes:
+        raise HTTPException(status_code=404, detail=f"No breakdown table for node {export.node!r}")
+    by = [column for column in dict.fromkeys(export.by or []) if column != "Gender"]
+    metrics = plan.columns(export.node)
+    present = plan.node_alias(export.node)
+    width = len(by) + 1
+
+    def transform(rows):
+        # Same rows as the JSON tables: one per Gender with any cases at the node
+        return [
+            (*row[:width], *(row._mapping[alias] if alias else 0 for _, alias in metrics))
+            for row in rows if row._mapping[present]
+        ]
+
+    columns = by + ["Gender"] + [field for field, _ in metrics]
+    types = [str] * width + [int] * len(metrics)
+    return export_response(breakdown_export_statement(plan, export, by), columns, types, export.format,
+                           "breakdown", transform)
+
+
+@app.get("/admin/cache/stats", dependencies=[Depends(require_admin)])
+def cache_stats():
+    return {**sankey_cache.stats(), "breakdown": breakdown_cache.stats(), "singleFlight": query_flights.stats()}
+
+
+async def reload_data(full=False):
+    # Loaded snapshots are rebuilt and loaded rollups have their changed months recomputed
+    # first (still serving the old data meanwhile) so the cleared caches cannot be refilled
+    # from stale data. A full reload drops the rollups instead, as a change the month
+    # signatures cannot see must not survive an explicit invalidate.
+    if full:
+        rollup_cube.invalidate()
+        event_rollups.invalidate()
+    await asyncio.gather(
+        *(snapshot.refresh() for snapshot in (sankey_snapshot, events_snapshot) if snapshot.loaded),
+        *(cube.refresh() for cube in (rollup_cube, event_rollups) if not full),
+    )
+    # Shared caches are keyed by the data version, so the other workers' entries for the
+    # new version must survive; only this worker's own caches are cleared.
+    for cache in (sankey_cache, breakdown_cache):
+        if not cache.shared:
+            await cache.clear()
+    facet_service.invalidate()
+    # Re-read last, so a new ETag is never issued for a response from the old data
+    data_version.invalidate(bump=full)
+    await data_version.ensure_loaded()
+
+
+async def warm_flows(filters, response_format="links"):
+    filters = SankeyFilter(**filters)
+    if sankey_cache.shared and await sankey_cache.get(filter_key(filters, response_format)) is not None:
+        # Already warmed by another worker
+        return
+    flows = await in_memory_flows(filters)
+    if flows is None:
+        flows = await asyncio.wait_for(run_db(query_sankey_flows, filters), SANKEY_QUERY_TIMEOUT)
+    await sankey_cache.set(filter_key(filters, response_format), encode_flows(flows, response_format == "compact"))
+
+
+async def warm_caches():
+    """Recompute national, per-county and per-partner flows for the default window, then the top requests."""
+    await facet_service.load_async()
+    if rollup_cube.enabled and not rollup_cube.loaded and SANKEY_ENGINE != "snapshot":
+        await rollup_cube.build()
+    requests = [({}, "links")]
+    requests += [({"County": [county]}, "links") for county in facet_service.counties]
+    requests += [({"Partner": [partner]}, "links") for partner in facet_service.partners]
+    requests += [request for request in request_log.most_common(WARM_TOP_FILTERS) if request not in requests]
+    warmed = await warm_all(requests, warm_flows)
+    logger.info("Warmed %d of %d Sankey filters", warmed, len(requests))
+    return warmed
+
+
+async def startup_warmup():
+    """Build what the first requests would otherwise pay for: pooled connections, the data
+    version, facet dictionaries, snapshots or rollups, and the common responses (running
+    them also fills SQLAlchemy's compiled-statement cache)."""
+    await asyncio.get_running_loop().run_in_executor(db_executor, warm_pool)
+    await data_version.ensure_loaded()
+    if SANKEY_ENGINE == "snapshot":
+        await sankey_snapshot.ensure_loaded()
+    if BREAKDOWN_ENGINE == "snapshot":
+        await events_snapshot.ensure_loaded()
+    elif event_rollups.enabled and not event_rollups.loaded:
+        await event_rollups.build()
+    await warm_caches()
+    await breakdown_rows(BreakdownPlan(list(NODES)), SankeyBreakdownBatch())
+
+
+# Polls the data version and reloads/warms on change; started with the app
+refresh_watcher = RefreshWatcher(reload_data, warm_caches)
+# Runs startup_warmup in the background; /readyz fails until it has completed
+readiness = Readiness(startup_warmup)
+
+
+@app.get("/healthz")
+def healthz():
+    # Liveness only: the process is serving requests, whether or not it is warm
+    return {"status": "ok"}
+
+
+@app.get("/readyz")
+def readyz():
+    stats = readiness.stats()
+    return FastJSONResponse(stats, status_code=200 if readiness.ready else 503)
+
+
+@app.post("/admin/cache/invalidate", dependencies=[Depends(require_admin)])
+async def invalidate_cache(warm: bool = False):
+    # Call after each warehouse load of CSAggregateSentinelSankey / CsSentinelEvents
+    # (the refresh watcher does this by itself when DATA_REFRESH_POLL_SECONDS > 0).
+    await reload_data(full=True)
+    # Also drops shared entries: the data may have changed without the version indicator
+    # (the full reload bumps the version for the ETags, but only in this worker)
+    await sankey_cache.clear()
+    await breakdown_cache.clear()
+    if warm:
+        await warm_caches()
+    return sankey_cache.stats()
+
+
+@app.get("/admin/refresh", dependencies=[Depends(require_admin)])
+def refresh_stats():
+    return refresh_watcher.stats()
+
+
+@app.get("/admin/rollups", dependencies=[Depends(require_admin)])
+def rollup_stats():
+    return {"sankey": rollup_cube.stats(), "breakdown": event_rollups.stats()}
+
+
+@app.post("/admin/index-advisor", dependencies=[Depends(require_admin)])
+async def index_advisor(apply: bool = False, keep: bool = False, limit: int = ADVISOR_REPLAY_LIMIT):
+    # By default only reports the recommended DDL. apply creates the indexes to time them
+    # (dropped again unless keep); run off-peak.
+    if (apply or keep) and not (ADMIN_TOKEN and INDEX_ADVISOR_APPLY):
+        raise HTTPException(status_code=403, detail="Creating indexes needs ADMIN_TOKEN and INDEX_ADVISOR_APPLY=true")
+    return await run_db(advise, request_log.most_common(limit), limit, apply, keep)
+
+
+@app.get("/admin/db/pool", dependencies=[Depends(require_admin)])
+def db_pool_stats():
+    return pool_status()
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def prometheus_metrics():
+    cache = sankey_cache.stats()
+    breakdown = breakdown_cache.stats()
+    pool = pool_status()
+    return metrics.render(gauges=[
+        ("sankey_cache_entries", cache["size"], "Entries in the Sankey result cache"),
+        ("sankey_cache_hits", cache["hits"], "Sankey result cache hits"),
+        ("sankey_cache_misses", cache["misses"], "Sankey result cache misses"),
+        ("sankey_cache_evictions", cache["evictions"], "Sankey result cache evictions"),
+        ("breakdown_cache_hits", breakdown["hits"], "Breakdown result cache hits"),
+        ("breakdown_cache_misses", breakdown["misses"], "Breakdown result cache misses"),
+        ("sankey_singleflight_leaders", sum(query_flights.leaders.values()), "Queries started by single-flight"),
+        ("sankey_singleflight_coalesced", sum(query_flights.coalesced.values()),
+         "Requests that joined an identical in-flight query"),
+        ("sankey_singleflight_in_flight", query_flights.stats()["inFlight"], "Distinct queries currently in flight"),
+        ("db_pool_in_use", pool["in_use"], "Checked-out connections"),
+        ("db_pool_idle", pool["idle"], "Idle pooled connections"),
+        ("db_pool_checkout_wait_seconds", pool["wait_time_total"], "Total time spent waiting for a connection"),
+        ("db_pool_connection_errors", pool["connection_errors"], "Failed connection attempts"),
+    ])
 
 
 @app.get("/")
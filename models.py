@@ -1,9 +1,39 @@
-from typing import Optional
+import os
+from typing import Optional, List, Union, Literal
 
-from pydantic import BaseModel
-from sqlalchemy import Column, Integer, String, PrimaryKeyConstraint
+from pydantic import BaseModel, Field
+from sqlalchemy import Column, Integer, String, PrimaryKeyConstraint, Table
 from database import Base
 
+# Cohort window applied when a request does not bound CohortYearMonth (end is exclusive)
+DEFAULT_COHORT_START = '2023-01-01'
+DEFAULT_COHORT_END = '2024-01-01'
+
+# Most filter sets accepted by /sankey-data/batch
+SANKEY_BATCH_MAX = int(os.getenv("SANKEY_BATCH_MAX", "50"))
+
+# SankeyFilter list fields and the CSAggregateSentinelSankey columns they filter
+FILTER_COLUMNS = {
+    "County": "County",
+    "SubCounty": "SubCounty",
+    "Agency": "AgencyName",
+    "Partner": "PartnerName",
+    "Gender": "Gender",
+    "AgeGroup": "AgeGroup",
+}
+
+
+def in_window(month, start, end, end_inclusive):
+    return month is not None and start <= month and (month <= end if end_inclusive else month < end)
+
+
+def cohort_window(filters):
+    """(start, end, end_inclusive) CohortYearMonth bounds with the defaults applied."""
+    start = filters.CohortYearMonthStart or DEFAULT_COHORT_START
+    if filters.CohortYearMonthEnd:
+        return start, filters.CohortYearMonthEnd, True
+    return start, DEFAULT_COHORT_END, False
+
 
 class CaseBreakdown(Base):
     __tablename__ = "CSAggregateSentinelSankey"
@@ -28,6 +58,35 @@ class CaseBreakdown(Base):
     )
 
 
+# Patient-level table behind the node breakdowns; it has no declared key, so it is
+# mapped as a Core table rather than an ORM class.
+sentinel_events = Table(
+    "CsSentinelEvents", Base.metadata,
+    Column("County", String),
+    Column("SubCounty", String),
+    Column("AgencyName", String),
+    Column("PartnerName", String),
+    Column("Gender", String),
+    Column("AgeGroup", String),
+    Column("CohortYearMonth", String),
+    Column("LinkedToART", Integer),
+    Column("NotLinkedOnART", Integer),
+    Column("WithBaselineCD4", Integer),
+    Column("WithoutBaselineCD4", Integer),
+    Column("AHD", Integer),
+    Column("NotStaged", Integer),
+    Column("WithInitialViralLoad", Integer),
+    Column("WithoutInitialViralLoad", Integer),
+    Column("IsSuppressedInitialViralload", Integer),
+    Column("RegimenChanged", Integer),
+    Column("RegimenNotChanged", Integer),
+    Column("LatestVLSuppressed", Integer),
+    Column("LatestVLNotSuppressed", Integer),
+    Column("PatientRetained", Integer),
+    Column("PatientNotRetained", Integer),
+)
+
+
 class SankeyFilter(BaseModel):
     County: Optional[list] = None
     SubCounty: Optional[list] = None
@@ -39,8 +98,32 @@ class SankeyFilter(BaseModel):
     AgeGroup: Optional[list] = None
 
 
+class SankeyFilterQuery(SankeyFilter):
+    # GET /sankey-data/ takes its filters and the response format from the query string
+    format: Optional[Literal["links", "compact"]] = None
+
+
+class SankeyBatch(BaseModel):
+    filters: List[SankeyFilter] = Field(..., min_length=1, max_length=SANKEY_BATCH_MAX)
+
+
+# Filter fields (or the cohort month) an export can be broken down by, on top of the links
+# (Sankey) or Gender (breakdown)
+ExportDimension = Literal["County", "SubCounty", "Agency", "Partner", "Gender", "AgeGroup", "CohortYearMonth"]
+
+
+class SankeyExport(SankeyFilter):
+    format: Literal["csv", "ndjson", "parquet"] = "csv"
+    by: Optional[List[ExportDimension]] = None
+
+
+# Breakdown tables are by Gender unless other dimensions (filter field names) are asked for
+BreakdownDimension = Literal["Gender", "AgeGroup", "County", "SubCounty", "Agency", "Partner"]
+
+
 class SankeyBreakdown(BaseModel):
     node: str
+    dimensions: Optional[List[BreakdownDimension]] = None
     CohortYearMonthStart: Optional[str] = None
     CohortYearMonthEnd: Optional[str] = None
     County: Optional[list] = None
@@ -49,3 +132,78 @@ class SankeyBreakdown(BaseModel):
     Partner: Optional[list] = None
     Gender: Optional[list] = None
     AgeGroup: Optional[list] = None
+
+
+class SankeyBreakdownBatch(BaseModel):
+    nodes: Optional[list] = None
+    dimensions: Optional[List[BreakdownDimension]] = None
+    CohortYearMonthStart: Optional[str] = None
+    CohortYearMonthEnd: Optional[str] = None
+    County: Optional[list] = None
+    SubCounty: Optional[list] = None
+    Agency: Optional[list] = None
+    Partner: Optional[list] = None
+    Gender: Optional[list] = None
+    AgeGroup: Optional[list] = None
+
+
+class BreakdownExport(SankeyBreakdown):
+    format: Literal["csv", "ndjson", "parquet"] = "csv"
+    by: Optional[List[ExportDimension]] = None
+
+
+# Response shapes, for the OpenAPI schema and the startup check in breakdown.check_tables;
+# responses themselves are serialized directly and not validated per request.
+class SankeyLink(BaseModel):
+    source: Optional[str] = Field(alias="from")
+    target: Optional[str] = Field(alias="to")
+    weight: Optional[int]
+
+
+class CompactSankeyData(BaseModel):
+    nodes: List[Optional[str]]
+    sourceIdx: List[int]
+    targetIdx: List[int]
+    weight: List[Optional[int]]
+
+
+class SankeyResponse(BaseModel):
+    sankeyData: Union[List[SankeyLink], CompactSankeyData]
+    uniqueCounties: List[Optional[str]]
+    uniqueSubCounties: List[Optional[str]]
+    uniquePartners: List[Optional[str]]
+    uniqueAgencies: List[Optional[str]]
+    errors: Optional[List[str]] = None
+
+
+class SankeySeries(BaseModel):
+    sankeyData: Union[List[SankeyLink], CompactSankeyData]
+
+
+class SankeyBatchResponse(BaseModel):
+    series: List[SankeySeries]
+    uniqueCounties: List[Optional[str]]
+    uniqueSubCounties: List[Optional[str]]
+    uniquePartners: List[Optional[str]]
+    uniqueAgencies: List[Optional[str]]
+    errors: Optional[List[str]] = None
+
+
+class SankeyFacets(BaseModel):
+    uniqueCounties: List[Optional[str]]
+    uniqueSubCounties: List[Optional[str]]
+    uniquePartners: List[Optional[str]]
+    uniqueAgencies: List[Optional[str]]
+
+
+class BreakdownColumn(BaseModel):
+    field: str
+    headerName: str
+    flex: int
+    minWidth: int
+
+
+class BreakdownTable(BaseModel):
+    tableTitle: str
+    columns: List[BreakdownColumn]
+    rows: List[dict]
@@ -0,0 +1,319 @@
+import asyncio
+import bisect
+import logging
+import os
+import threading
+
+from sqlalchemy import func, select
+
+from breakdown import BreakdownPlan, NODES, FLAG_COLUMNS, DEFAULT_DIMENSIONS
+from database import run_db
+from instrumentation import start_background
+from models import CaseBreakdown, FILTER_COLUMNS, cohort_window, sentinel_events
+
+logger = logging.getLogger(__name__)
+
+SANKEY_ROLLUPS_ENABLED = os.getenv("SANKEY_ROLLUPS_ENABLED", "true").lower() in ("1", "true", "yes")
+# Semicolon-separated rollups, each a comma-separated list of CSAggregateSentinelSankey
+# columns. The all-dimensions-rolled-up (national) rollup is always built.
+SANKEY_ROLLUPS = os.getenv("SANKEY_ROLLUPS", "County;PartnerName;AgencyName")
+# Same for the CsSentinelEvents breakdown counters; Gender is always kept, as the tables are by sex
+BREAKDOWN_ROLLUPS_ENABLED = os.getenv("BREAKDOWN_ROLLUPS_ENABLED", "true").lower() in ("1", "true", "yes")
+BREAKDOWN_ROLLUPS = os.getenv("BREAKDOWN_ROLLUPS", SANKEY_ROLLUPS)
+
+# Every conjunction any registry node needs, so one events rollup answers any breakdown plan
+EVENTS_PLAN = BreakdownPlan(list(NODES))
+
+
+def parse_rollups(spec):
+    rollups = [()]
+    for part in spec.split(";"):
+        dims = tuple(sorted(column.strip() for column in part.split(",") if column.strip()))
+        if dims and dims not in rollups:
+            rollups.append(dims)
+    return rollups
+
+
+def month_filter(column, months):
+    # Rows without a CohortYearMonth never fall in a requested window
+    if months is None:
+        return column.isnot(None)
+    return column.in_(months)
+
+
+def query_rollup(db, dims, months=None):
+    columns = [getattr(CaseBreakdown, dim) for dim in dims]
+    group = columns + [CaseBreakdown.CohortYearMonth, CaseBreakdown.ord, CaseBreakdown.source, CaseBreakdown.target]
+    return db.query(*group, func.sum(CaseBreakdown.metric).label('total_metric')) \
+        .filter(month_filter(CaseBreakdown.CohortYearMonth, months)).group_by(*group).all()
+
+
+def content_checksum(db, columns):
+    # Counts and sums miss values that move between counties/partners/genders within a
+    # month; MSSQL can checksum the rows themselves. Other dialects rely on the admin
+    # invalidate, which rebuilds the rollups from scratch.
+    if db.get_bind().dialect.name == "mssql":
+        return [func.checksum_agg(func.binary_checksum(*columns))]
+    return []
+
+
+def query_sankey_months(db):
+    table = CaseBreakdown.__table__
+    columns = [table.c[column] for column in FILTER_COLUMNS.values()] + [table.c.ord, table.c.source,
+                                                                         table.c.target, table.c.metric]
+    return db.query(CaseBreakdown.CohortYearMonth, func.count(), func.sum(CaseBreakdown.metric),
+                    *content_checksum(db, columns)) \
+        .group_by(CaseBreakdown.CohortYearMonth).all()
+
+
+def query_event_rollup(db, dims, months=None):
+    table = sentinel_events
+    group = [table.c[dim] for dim in dims] + [table.c.CohortYearMonth, table.c.Gender]
+    statement = select(*group, *EVENTS_PLAN.aggregates(table)) \
+        .where(month_filter(table.c.CohortYearMonth, months)).group_by(*group)
+    return db.execute(statement).all()
+
+
+def query_event_months(db):
+    table = sentinel_events
+    columns = [table.c[column] for column in list(FILTER_COLUMNS.values()) + FLAG_COLUMNS]
+    statement = select(table.c.CohortYearMonth, func.count(), *(func.sum(table.c[column]) for column in FLAG_COLUMNS),
+                       *content_checksum(db, columns)) \
+        .group_by(table.c.CohortYearMonth)
+    return db.execute(statement).all()
+
+
+class Rollup:
+    """Partial aggregates over ``dims``, partitioned by CohortYearMonth.
+
+    Rows are (dimension values..., CohortYearMonth, payload...). Instances are not
+    modified once built; replace() returns a copy sharing the untouched months.
+    """
+
+    def __init__(self, dims, months):
+        self.dims = dims
+        # {CohortYearMonth: {dimension values: [payload, ...]}}
+        self.months = months
+        self.order = sorted(months)
+        self.size = sum(len(payloads) for cells in months.values() for payloads in cells.values())
+
+    @staticmethod
+    def partition(dims, rows):
+        months = {}
+        width = len(dims)
+        for row in rows:
+            cells = months.setdefault(row[width], {})
+            cells.setdefault(tuple(row[:width]), []).append(tuple(row[width + 1:]))
+        return months
+
+    @classmethod
+    def from_rows(cls, dims, rows):
+        return cls(dims, cls.partition(dims, rows))
+
+    def replace(self, months, rows):
+        """Copy with ``months`` recomputed from ``rows`` (months missing from rows are dropped)."""
+        replaced = {month: cells for month, cells in self.months.items() if month not in months}
+        replaced.update(self.partition(self.dims, rows))
+        return Rollup(self.dims, replaced)
+
+    def cells(self, selected, start, end, end_inclusive):
+        """(dimension values, payloads) of the matching cells in the window."""
+        # Only the months inside the window are visited, so a range costs O(months) lookups
+        low = bisect.bisect_left(self.order, start)
+        high = bisect.bisect_right(self.order, end) if end_inclusive else bisect.bisect_left(self.order, end)
+        for month in self.order[low:high]:
+            for values, payloads in self.months[month].items():
+                if any(value not in selected[dim] for dim, value in zip(self.dims, values) if dim in selected):
+                    continue
+                yield values, payloads
+
+    def payloads(self, selected, start, end, end_inclusive):
+        for _, payloads in self.cells(selected, start, end, end_inclusive):
+            yield from payloads
+
+
+class RollupCube:
+    """Month-partitioned rollups of a table for common filter shapes.
+
+    A request is answered from the smallest rollup whose dimensions cover every
+    filtered column by adding up the monthly partials in its window; anything else
+    falls back to the base table. After a warehouse load only the months whose
+    signature (row count, column sums and, on MSSQL, a row checksum per month) changed
+    are recomputed.
+    """
+
+    query = None
+    query_months = None
+
+    def __init__(self, rollups, enabled):
+        self.enabled = enabled
+        self.definitions = rollups
+        self.rollups = []
+        self.signatures = {}
+        self._build = None
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._refresh_lock = asyncio.Lock()
+        self.routed = 0
+        self.fallbacks = 0
+        self.refreshed_months = []
+
+    @property
+    def loaded(self):
+        return bool(self.rollups)
+
+    async def _signatures(self):
+        rows = await run_db(self.query_months)
+        return {row[0]: tuple(row[1:]) for row in rows if row[0] is not None}
+
+    async def build(self):
+        generation = self._generation
+        # Signatures are read first, so a load racing the build shows up as changed months later
+        signatures = await self._signatures()
+        results = await asyncio.gather(*(run_db(self.query, dims) for dims in self.definitions))
+        rollups = sorted((Rollup.from_rows(dims, rows) for dims, rows in zip(self.definitions, results)),
+                         key=lambda rollup: rollup.size)
+        with self._lock:
+            # Drop the result if the data was invalidated while the build was running
+            if generation == self._generation:
+                self.rollups = rollups
+                self.signatures = signatures
+
+    async def refresh(self):
+        """Recompute the months changed since the last build/refresh; returns them."""
+        if not self.loaded:
+            # Nothing to patch; the next request builds from scratch
+            self.invalidate()
+            return []
+        async with self._refresh_lock:
+            generation = self._generation
+            signatures = await self._signatures()
+            changed = sorted(month for month in set(signatures) | set(self.signatures)
+                             if signatures.get(month) != self.signatures.get(month))
+            rollups = self.rollups
+            if changed:
+                results = await asyncio.gather(*(run_db(self.query, rollup.dims, changed) for rollup in rollups))
+                rollups = sorted((rollup.replace(set(changed), rows) for rollup, rows in zip(rollups, results)),
+                                 key=lambda rollup: rollup.size)
+            with self._lock:
+                if generation == self._generation:
+                    self.rollups = rollups
+                    self.signatures = signatures
+                    self.refreshed_months = changed
+            return changed
+
+    def ensure_building(self):
+        # Builds in the background; requests use the base table until it is ready
+        if not self.enabled or self.loaded or (self._build is not None and not self._build.done()):
+            return
+        self._build = start_background(self.build())
+        self._build.add_done_callback(self._log_failure)
+
+    @staticmethod
+    def _log_failure(task):
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Rollup build failed", exc_info=task.exception())
+
+    def invalidate(self):
+        with self._lock:
+            self._generation += 1
+            self.rollups = []
+            self.signatures = {}
+
+    def route(self, selected):
+        with self._lock:
+            rollups = self.rollups
+        for rollup in rollups:
+            if set(selected) <= set(rollup.dims):
+                self.routed += 1
+                return rollup
+        self.fallbacks += 1
+        return None
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "loaded": self.loaded,
+            "months": len(self.signatures),
+            "rollups": [{"dims": list(rollup.dims), "rows": rollup.size} for rollup in self.rollups],
+            "routed": self.routed,
+            "fallbacks": self.fallbacks,
+            "refreshedMonths": self.refreshed_months,
+        }
+
+
+def selected_columns(filters, exclude=()):
+    return {
+        column: set(getattr(filters, field))
+        for field, column in FILTER_COLUMNS.items() if getattr(filters, field) and field not in exclude
+    }
+
+
+class SankeyRollups(RollupCube):
+    """CSAggregateSentinelSankey flows by month."""
+
+    query = staticmethod(query_rollup)
+    query_months = staticmethod(query_sankey_months)
+
+    def __init__(self, rollups=None, enabled=SANKEY_ROLLUPS_ENABLED):
+        super().__init__(rollups if rollups is not None else parse_rollups(SANKEY_ROLLUPS), enabled)
+
+    def flows(self, filters):
+        selected = selected_columns(filters)
+        rollup = self.route(selected)
+        if rollup is None:
+            return None
+        totals = {}
+        for ord_, source, target, total in rollup.payloads(selected, *cohort_window(filters)):
+            link = (ord_, source, target)
+            totals[link] = totals.get(link, 0) + (total or 0)
+        return [
+            {"from": source, "to": target, "weight": total}
+            for (ord_, source, target), total in sorted(totals.items(), key=lambda item: item[0][0])
+        ]
+
+
+class EventRollups(RollupCube):
+    """CsSentinelEvents breakdown counters (every EVENTS_PLAN conjunction) by month and Gender."""
+
+    query = staticmethod(query_event_rollup)
+    query_months = staticmethod(query_event_months)
+
+    def __init__(self, rollups=None, enabled=BREAKDOWN_ROLLUPS_ENABLED):
+        super().__init__(rollups if rollups is not None else parse_rollups(BREAKDOWN_ROLLUPS), enabled)
+
+    def counts(self, plan, filters, dimensions=DEFAULT_DIMENSIONS):
+        """{dimension: rows} of counts for a BreakdownPlan, shaped like its SQL rows, or None to use SQL."""
+        positions = {alias: index for index, alias in enumerate(EVENTS_PLAN.aliases.values())}
+        try:
+            columns = {alias: positions[EVENTS_PLAN.aliases[conjunction]] for conjunction, alias in plan.aliases.items()}
+        except KeyError:
+            return None
+        # Gender is part of every payload, so it filters rows rather than choosing a rollup
+        selected = selected_columns(filters, exclude=("Gender",))
+        genders = set(filters.Gender) if filters.Gender else None
+        tables = {}
+        for dimension in dimensions:
+            column = FILTER_COLUMNS[dimension]
+            # Any other dimension has to be a column of the rollup answering the request
+            rollup = self.route(selected if dimension == "Gender" else {**selected, column: None})
+            if rollup is None:
+                return None
+            position = None if dimension == "Gender" else rollup.dims.index(column)
+            totals = {}
+            for values, payloads in rollup.cells(selected, *cohort_window(filters)):
+                for gender, *counts in payloads:
+                    if genders is not None and gender not in genders:
+                        continue
+                    row = totals.setdefault(gender if position is None else values[position], [0] * len(counts))
+                    for index, count in enumerate(counts):
+                        row[index] += count or 0
+            tables[dimension] = [
+                {dimension: value, **{alias: row[index] for alias, index in columns.items()}}
+                for value, row in totals.items()
+            ]
+        return tables
+
+
+rollup_cube = SankeyRollups()
+event_rollups = EventRollups()
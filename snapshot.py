@@ -0,0 +1,303 @@
+import asyncio
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import select
+
+from breakdown import FLAG_COLUMNS, DEFAULT_DIMENSIONS
+from database import run_db
+from models import CaseBreakdown, FILTER_COLUMNS, cohort_window, sentinel_events
+from versioning import data_version
+
+try:
+    import fcntl
+except ImportError:  # not on Windows; only needed for SNAPSHOT_SHARED_DIR
+    fcntl = None
+
+# "sql" answers /sankey-data/ from MSSQL (via the rollups), "snapshot" from an in-process columnar copy
+SANKEY_ENGINE = os.getenv("SANKEY_ENGINE", "sql").lower()
+# Same choice for the CsSentinelEvents breakdown tables
+BREAKDOWN_ENGINE = os.getenv("BREAKDOWN_ENGINE", "sql").lower()
+# Directory (on local disk or tmpfs) where snapshots are written once and memory-mapped by
+# every worker on the host; empty keeps a private copy in each worker
+SNAPSHOT_SHARED_DIR = os.getenv("SNAPSHOT_SHARED_DIR", "")
+
+NULL_FLAG = 255
+
+
+def encode(values):
+    """Dictionary-encode a column: (codes, categories), with code 0 reserved for NULL."""
+    categorical = pd.Categorical(values)
+    dtype = np.int16 if len(categorical.categories) < np.iinfo(np.int16).max else np.int32
+    codes = categorical.codes.astype(dtype) + 1
+    return codes, np.asarray(categorical.categories, dtype=object)
+
+
+def lookup(categories, wanted):
+    # Boolean table indexed by code, so a filter on a column is a single gather
+    table = np.zeros(len(categories) + 1, dtype=bool)
+    positions = {value: code for code, value in enumerate(categories, start=1)}
+    for value in wanted:
+        code = positions.get(value)
+        if code is not None:
+            table[code] = True
+    return table
+
+
+def month_range(months, filters):
+    # months are the sorted CohortYearMonth categories, so string bounds become code bounds
+    start, end, end_inclusive = cohort_window(filters)
+    low = np.searchsorted(months, start, side="left") + 1
+    high = np.searchsorted(months, end, side="right" if end_inclusive else "left") + 1
+    return low, high
+
+
+class SharedStore:
+    """Snapshot arrays as .npy files that every worker maps read-only.
+
+    ``<name>.json`` points at the current build directory and is replaced atomically,
+    so a reader sees either the old or the new build. Dictionary-encoded columns keep
+    their codes in the arrays and their (small) categories in the build's meta.json.
+    ``<name>.lock`` makes one worker build while the others wait and then map its files.
+    """
+
+    def __init__(self, directory, name):
+        if fcntl is None:
+            raise RuntimeError("SNAPSHOT_SHARED_DIR needs fcntl file locks, which this platform does not have")
+        self.directory = directory
+        self.name = name
+        self.pointer_path = os.path.join(directory, f"{name}.json")
+        self.lock_path = os.path.join(directory, f"{name}.lock")
+        os.makedirs(directory, exist_ok=True)
+
+    def acquire(self):
+        lock = open(self.lock_path, "a")
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        return lock
+
+    @staticmethod
+    def release(lock):
+        fcntl.flock(lock, fcntl.LOCK_UN)
+        lock.close()
+
+    def pointer(self):
+        try:
+            with open(self.pointer_path) as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return None
+
+    def write(self, data, version):
+        build = f"{self.name}-{int(time.time() * 1000)}-{os.getpid()}"
+        path = os.path.join(self.directory, build)
+        os.makedirs(path)
+        meta = {"arrays": [], "dictionaries": {}, "values": {}}
+        for key, value in data.items():
+            if isinstance(value, tuple):
+                codes, categories = value
+                np.save(os.path.join(path, f"{key}.npy"), codes)
+                meta["dictionaries"][key] = categories.tolist()
+            elif isinstance(value, np.ndarray):
+                np.save(os.path.join(path, f"{key}.npy"), value)
+                meta["arrays"].append(key)
+            else:
+                meta["values"][key] = value
+        with open(os.path.join(path, "meta.json"), "w") as file:
+            json.dump(meta, file)
+
+        pointer = {"build": build, "version": version}
+        temporary = f"{self.pointer_path}.{os.getpid()}.tmp"
+        with open(temporary, "w") as file:
+            json.dump(pointer, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary, self.pointer_path)
+
+        # Workers still mapping an older build keep their pages after the unlink
+        for entry in os.listdir(self.directory):
+            if entry.startswith(f"{self.name}-") and entry != build:
+                shutil.rmtree(os.path.join(self.directory, entry), ignore_errors=True)
+        return pointer
+
+    def map(self, pointer):
+        path = os.path.join(self.directory, pointer["build"])
+        with open(os.path.join(path, "meta.json")) as file:
+            meta = json.load(file)
+        data = dict(meta["values"])
+        for key in meta["arrays"]:
+            data[key] = np.load(os.path.join(path, f"{key}.npy"), mmap_mode="r")
+        for key, categories in meta["dictionaries"].items():
+            data[key] = (np.load(os.path.join(path, f"{key}.npy"), mmap_mode="r"), np.asarray(categories, dtype=object))
+        return data
+
+
+class Snapshot:
+    """Double-buffered in-process copy of a table.
+
+    A refresh builds the replacement off to the side and swaps a single reference,
+    so readers keep using the previous buffer until the new one is complete.
+    """
+
+    name = None
+    query = None
+
+    def __init__(self, shared_dir=SNAPSHOT_SHARED_DIR):
+        self._lock = asyncio.Lock()
+        self.data = None
+        self.store = SharedStore(shared_dir, self.name) if shared_dir else None
+        self.mapped = None
+
+    @property
+    def loaded(self):
+        return self.data is not None
+
+    async def ensure_loaded(self):
+        if self.loaded:
+            return
+        async with self._lock:
+            if not self.loaded:
+                self.data = await self._load(rebuild=False)
+
+    async def refresh(self):
+        async with self._lock:
+            self.data = await self._load(rebuild=True)
+
+    async def _load(self, rebuild):
+        if self.store is None:
+            return await run_db(self.query)
+        # Whichever worker gets the lock first builds; the others then find the new
+        # build for the current data version and only map it
+        version = await data_version.probe()
+        loop = asyncio.get_running_loop()
+        lock = await loop.run_in_executor(None, self.store.acquire)
+        try:
+            pointer = self.store.pointer()
+            stale = pointer is None or pointer["version"] != version or (rebuild and pointer["build"] == self.mapped)
+            if stale:
+                data = await run_db(self.query)
+                pointer = await loop.run_in_executor(None, self.store.write, data, version)
+            # Mapped under the lock, since the next build removes this one
+            data = await loop.run_in_executor(None, self.store.map, pointer)
+        finally:
+            self.store.release(lock)
+        self.mapped = pointer["build"]
+        return data
+
+    def filter_mask(self, data, filters):
+        months, categories = data["CohortYearMonth"]
+        low, high = month_range(categories, filters)
+        mask = (months >= low) & (months < high)
+        for field, column in FILTER_COLUMNS.items():
+            wanted = getattr(filters, field)
+            if wanted:
+                codes, categories = data[column]
+                mask &= lookup(categories, wanted)[codes]
+        return mask
+
+
+class SankeySnapshot(Snapshot):
+    """Columnar copy of CSAggregateSentinelSankey for in-process filtering and group-sums."""
+
+    name = "sankey"
+
+    @staticmethod
+    def query(db):
+        columns = [CaseBreakdown.ord, CaseBreakdown.source, CaseBreakdown.target, CaseBreakdown.metric,
+                   CaseBreakdown.CohortYearMonth] + [getattr(CaseBreakdown, column) for column in FILTER_COLUMNS.values()]
+        frame = pd.read_sql_query(db.query(*columns).statement, db.connection())
+        return SankeySnapshot.build(frame)
+
+    @staticmethod
+    def build(frame):
+        data = {"rows": len(frame)}
+        for column in FILTER_COLUMNS.values():
+            data[column] = encode(frame[column])
+        data["CohortYearMonth"] = encode(frame["CohortYearMonth"])
+        data["metric"] = frame["metric"].fillna(0).to_numpy(dtype=np.int32)
+
+        # Every (ord, source, target) triple becomes one link id so the group-by is a bincount
+        links = frame[["ord", "source", "target"]].copy()
+        links["ord"] = links["ord"].fillna(0).astype(np.int32)
+        link_ids, uniques = pd.MultiIndex.from_frame(links).factorize(sort=True)
+        data["link"] = link_ids.astype(np.int32)
+        data["links"] = [(int(ord_), source, target) for ord_, source, target in uniques]
+        return data
+
+    def flows(self, filters):
+        data = self.data
+        mask = self.filter_mask(data, filters)
+        link = data["link"][mask]
+        count = np.bincount(link, minlength=len(data["links"]))
+        weight = np.bincount(link, weights=data["metric"][mask], minlength=len(data["links"]))
+        return [
+            {"from": source, "to": target, "weight": int(weight[index])}
+            for index, (ord_, source, target) in enumerate(data["links"]) if count[index]
+        ]
+
+
+class EventsSnapshot(Snapshot):
+    """Columnar copy of the patient-level CsSentinelEvents flags for breakdown counts."""
+
+    name = "events"
+
+    @staticmethod
+    def query(db):
+        columns = list(FILTER_COLUMNS.values()) + ["CohortYearMonth"] + FLAG_COLUMNS
+        frame = pd.read_sql_query(select(*(sentinel_events.c[column] for column in columns)), db.connection())
+        return EventsSnapshot.build(frame)
+
+    @staticmethod
+    def build(frame):
+        data = {"rows": len(frame)}
+        for column in FILTER_COLUMNS.values():
+            data[column] = encode(frame[column])
+        data["CohortYearMonth"] = encode(frame["CohortYearMonth"])
+        for column in FLAG_COLUMNS:
+            # 0/1 flags as uint8; NULL becomes 255 so it matches neither "= 0" nor "= 1", as in SQL
+            data[column] = frame[column].fillna(NULL_FLAG).to_numpy(dtype=np.uint8)
+        return data
+
+    def counts(self, plan, filters, dimensions=DEFAULT_DIMENSIONS):
+        """{dimension: rows} of counts for every conjunction in a BreakdownPlan, shaped like its SQL rows.
+
+        The conjunction masks are computed once and shared by every dimension.
+        """
+        data = self.data
+        mask = self.filter_mask(data, filters)
+        flags = {column: data[column][mask] for column in FLAG_COLUMNS}
+
+        masks = {(): None}
+
+        def conjunction_mask(conjunction):
+            # Conjunctions are sorted tuples, so nodes sharing a prefix share its AND
+            if conjunction not in masks:
+                column, value = conjunction[-1]
+                parent = conjunction_mask(conjunction[:-1])
+                condition = flags[column] == value
+                masks[conjunction] = condition if parent is None else parent & condition
+            return masks[conjunction]
+
+        tables = {}
+        for dimension in dimensions:
+            codes, categories = data[FILTER_COLUMNS[dimension]]
+            codes = codes[mask]
+            size = len(categories) + 1
+            totals = np.bincount(codes, minlength=size)
+            counts = {}
+            for conjunction, alias in plan.aliases.items():
+                selected = conjunction_mask(conjunction)
+                counts[alias] = totals if selected is None else np.bincount(codes[selected], minlength=size)
+            tables[dimension] = [
+                {dimension: categories[code - 1] if code else None,
+                 **{alias: int(values[code]) for alias, values in counts.items()}}
+                for code in range(size) if totals[code]
+            ]
+        return tables
+
+
+sankey_snapshot = SankeySnapshot()
+events_snapshot = EventsSnapshot()
@@ -0,0 +1,100 @@
+import asyncio
+import hashlib
+import logging
+import os
+import time
+
+from sqlalchemy import func, select, text
+
+from database import run_db
+from models import CaseBreakdown, sentinel_events
+
+logger = logging.getLogger(__name__)
+
+# Optional cheaper/more precise change indicator, e.g. "SELECT MAX(LoadDate) FROM dbo.EtlLoadLog";
+# by default the row counts, latest CohortYearMonth and metric total of the tables are used.
+DATA_VERSION_SQL = os.getenv("DATA_VERSION_SQL")
+HTTP_CACHE_CONTROL = os.getenv("HTTP_CACHE_CONTROL", "public, no-cache")
+# Seconds a request waits for the indicator, and pause before probing again after a failure
+DATA_VERSION_TIMEOUT = float(os.getenv("DATA_VERSION_TIMEOUT", "2"))
+DATA_VERSION_RETRY_SECONDS = float(os.getenv("DATA_VERSION_RETRY_SECONDS", "5"))
+
+
+def query_indicator(db):
+    if DATA_VERSION_SQL:
+        return [tuple(row) for row in db.execute(text(DATA_VERSION_SQL)).all()]
+    # Metric totals catch reloads that only change values; on MSSQL a checksum of the
+    # rows also catches values moving between dimension members
+    sankey = [func.count(), func.max(CaseBreakdown.CohortYearMonth), func.sum(CaseBreakdown.metric)]
+    events = [func.count(), func.max(sentinel_events.c.CohortYearMonth)]
+    if db.get_bind().dialect.name == "mssql":
+        sankey.append(func.checksum_agg(func.binary_checksum(*CaseBreakdown.__table__.c)))
+        events.append(func.checksum_agg(func.binary_checksum(*sentinel_events.c)))
+    return [
+        tuple(db.execute(select(*sankey)).one()),
+        tuple(db.execute(select(*events).select_from(sentinel_events)).one()),
+    ]
+
+
+class DataVersion:
+    """Version token of the warehouse tables, derived from a cheap change indicator."""
+
+    def __init__(self):
+        self._lock = asyncio.Lock()
+        self.version = None
+        # Bumped by explicit invalidations, so they change the version (and the ETags)
+        # even when the indicator cannot see what the reload changed
+        self.refreshes = 0
+        self._generation = 0
+        self._retry_at = 0.0
+
+    async def probe(self):
+        """Version the indicator reports now, without adopting it."""
+        indicator = await run_db(query_indicator)
+        return hashlib.sha1(repr((indicator, self.refreshes)).encode()).hexdigest()[:16]
+
+    def invalidate(self, bump=False):
+        if bump:
+            self.refreshes += 1
+        self._generation += 1
+        self._retry_at = 0.0
+        self.version = None
+
+    async def ensure_loaded(self):
+        # Without a version no validators are sent and requests are answered in full, so
+        # requests never queue behind a probe already running or a slow/failing indicator
+        if self.version is None and not self._lock.locked() and time.monotonic() >= self._retry_at:
+            async with self._lock:
+                generation = self._generation
+                try:
+                    version = await asyncio.wait_for(self.probe(), DATA_VERSION_TIMEOUT)
+                except Exception:
+                    logger.exception("Data version indicator query failed")
+                    self._retry_at = time.monotonic() + DATA_VERSION_RETRY_SECONDS
+                else:
+                    # A probe that started before an invalidation may have read the old data
+                    if generation == self._generation:
+                        self.version = version
+        return self.version
+
+
+data_version = DataVersion()
+
+
+def etag(version, *parts):
+    digest = hashlib.sha1(repr(parts).encode()).hexdigest()[:16]
+    # Weak: the same representation may be sent with different Content-Encodings
+    return f'W/"{version}-{digest}"'
+
+
+def matches(if_none_match, tag):
+    if not if_none_match:
+        return False
+    candidates = [candidate.strip() for candidate in if_none_match.split(",")]
+    return "*" in candidates or any(candidate.removeprefix("W/") == tag.removeprefix("W/") for candidate in candidates)
+
+
+def cache_headers(tag):
+    if tag is None:
+        return {}
+    return {"ETag": tag, "Cache-Control": HTTP_CACHE_CONTROL}
@@ -0,0 +1,179 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from collections import Counter
+
+from versioning import data_version
+
+logger = logging.getLogger(__name__)
+
+# Seconds between polls of the data version indicator; 0 disables the watcher
+DATA_REFRESH_POLL_SECONDS = float(os.getenv("DATA_REFRESH_POLL_SECONDS", "300"))
+# Most frequently requested filters re-computed after a refresh, on top of national/county/partner
+WARM_TOP_FILTERS = int(os.getenv("WARM_TOP_FILTERS", "50"))
+WARM_CONCURRENCY = int(os.getenv("WARM_CONCURRENCY", "4"))
+REQUEST_LOG_MAXSIZE = int(os.getenv("REQUEST_LOG_MAXSIZE", "2000"))
+# Warm pools, dictionaries and caches before reporting ready; false reports ready immediately
+STARTUP_WARMUP = os.getenv("STARTUP_WARMUP", "true").lower() in ("1", "true", "yes")
+STARTUP_RETRY_SECONDS = float(os.getenv("STARTUP_RETRY_SECONDS", "15"))
+
+
+class RequestLog:
+    """Bounded frequency count of the Sankey filters clients ask for."""
+
+    def __init__(self, maxsize=REQUEST_LOG_MAXSIZE):
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self.counts = Counter()
+        self.requests = {}
+
+    def record(self, key, filters, response_format):
+        with self._lock:
+            if key not in self.requests:
+                if len(self.requests) >= self.maxsize:
+                    # Keep the more frequent half; one-off filters are not worth warming
+                    for stale, _ in self.counts.most_common()[self.maxsize // 2:]:
+                        del self.counts[stale]
+                        del self.requests[stale]
+                self.requests[key] = (filters.model_dump(exclude_none=True), response_format)
+            self.counts[key] += 1
+
+    def most_common(self, count):
+        with self._lock:
+            return [self.requests[key] for key, _ in self.counts.most_common(count)]
+
+
+request_log = RequestLog()
+
+
+class RefreshWatcher:
+    """Background task polling the data version; on a change it reloads and then pre-warms."""
+
+    def __init__(self, reload, warm, interval=DATA_REFRESH_POLL_SECONDS):
+        self.reload = reload
+        self.warm = warm
+        self.interval = interval
+        self._task = None
+        self.refreshes = 0
+        self.last_warmed = 0
+
+    def start(self):
+        if self.interval > 0 and self._task is None:
+            self._task = asyncio.ensure_future(self.run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.check()
+            except Exception:
+                logger.exception("Data refresh check failed")
+
+    async def check(self):
+        # Probing leaves the served version alone until the caches have been reloaded
+        version = await data_version.probe()
+        if data_version.version is None:
+            # First poll only establishes the baseline
+            data_version.version = version
+            return False
+        if version == data_version.version:
+            return False
+        logger.info("Data version changed to %s, reloading caches", version)
+        await self.reload()
+        self.refreshes += 1
+        self.last_warmed = await self.warm()
+        return True
+
+    def stats(self):
+        return {
+            "interval": self.interval,
+            "running": self._task is not None and not self._task.done(),
+            "version": data_version.version,
+            "refreshes": self.refreshes,
+            "lastWarmed": self.last_warmed,
+        }
+
+
+class Readiness:
+    """Runs the startup warm-up in the background and reports ready once it has completed.
+
+    The app serves (and answers liveness probes) meanwhile; a failed warm-up, e.g.
+    with the database unreachable, is retried and the worker stays not ready.
+    """
+
+    def __init__(self, warm, enabled=STARTUP_WARMUP, retry=STARTUP_RETRY_SECONDS):
+        self.warm = warm
+        self.enabled = enabled
+        self.retry = retry
+        self.ready = not enabled
+        self._task = None
+        self.started = None
+        self.seconds = None
+        self.failures = 0
+        self.last_error = None
+
+    def start(self):
+        if not self.ready and self._task is None:
+            self._task = asyncio.ensure_future(self.run())
+
+    async def stop(self):
+        # Shutting down: stop taking new traffic while in-flight requests finish
+        self.ready = False
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def run(self):
+        self.started = time.time()
+        while True:
+            try:
+                await self.warm()
+                break
+            except Exception as error:
+                self.failures += 1
+                self.last_error = repr(error)
+                logger.exception("Startup warm-up failed, retrying in %ss", self.retry)
+                await asyncio.sleep(self.retry)
+        self.seconds = round(time.time() - self.started, 3)
+        self.ready = True
+        logger.info("Startup warm-up done in %.1fs", self.seconds)
+
+    def stats(self):
+        return {
+            "ready": self.ready,
+            "warmup": self.enabled,
+            "seconds": self.seconds,
+            "failures": self.failures,
+            "lastError": self.last_error,
+        }
+
+
+async def warm_all(requests, warm_one, concurrency=WARM_CONCURRENCY):
+    """Run warm_one(filters, response_format) for each request, a few at a time; returns the count warmed."""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def warm(filters, response_format):
+        async with semaphore:
+            try:
+                await warm_one(filters, response_format)
+                return True
+            except Exception:
+                logger.warning("Warming %s failed", filters, exc_info=True)
+                return False
+
+    return sum(await asyncio.gather(*(warm(*request) for request in requests)))